@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# offline benchmark of agent fetch-and-run pipeline: serves a synthetic project from a local http server
+# mimicking nginx (autoindex_format json, ETag/304, Range, hidden dot files), drives agent download and
+# change detection code against it and reports wall time, throughput, request counts, latency percentiles
+# and peak RSS. "play" mode runs a trivial local playbook through ansible_play to measure startup overhead.
+#
+#   ./agent-bench.py crawl --files 2000 --depth 3 --size 4096 --latency-ms 2
+#   ./agent-bench.py all --json
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import importlib.util
+import threading
+from multiprocessing import Process
+from email.utils import formatdate
+from urllib.parse import unquote
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+AGENT_PATH = os.path.join(BENCH_DIR, '..', 'ansible-agent.py')
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', '..', 'ansible-server'))
+from ansible_server_functions import build_manifest, make_bundle, write_json
+
+HOSTNAME = 'bench.local'
+COMMIT = '1600000000_0123456789abcdef0123456789abcdef01234567'
+
+
+class Handler(BaseHTTPRequestHandler):
+    # subset of nginx behaviour the agent relies on
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body=b'', headers={}):
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        path = os.path.join(server.root, unquote(self.path.split('?')[0]).lstrip('/'))
+        if os.path.isdir(path):
+            # autoindex hides dot files
+            listing = []
+            for name in sorted(os.listdir(path)):
+                if name.startswith('.'):
+                    continue
+                st = os.stat(os.path.join(path, name))
+                entry = {'name': name, 'mtime': formatdate(st.st_mtime, usegmt=True)}
+                if os.path.isdir(os.path.join(path, name)):
+                    entry['type'] = 'directory'
+                else:
+                    entry.update(type='file', size=st.st_size)
+                listing.append(entry)
+            return self.send(200, json.dumps(listing).encode(), {'Content-Type': 'application/json'})
+        if not os.path.isfile(path):
+            return self.send(404)
+        st = os.stat(path)
+        etag = f'"{int(st.st_mtime):x}-{st.st_size:x}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, headers={'ETag': etag})
+        with open(path, 'rb') as f:
+            body = f.read()
+        with server.lock:
+            server.bytes += len(body)
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            start = int(range_header[6:].split('-')[0])
+            if start >= len(body):
+                return self.send(416, headers={'Content-Range': f'bytes */{len(body)}'})
+            return self.send(206, body[start:], {'ETag': etag, 'Content-Range': f'bytes {start}-{len(body) - 1}/{len(body)}'})
+        self.send(200, body, {'ETag': etag})
+
+    do_HEAD = do_GET
+
+
+class BenchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, latency):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.root = root
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.bytes = 0
+
+
+def make_tree(path, files, depth, size, roles):
+    # synthetic project: roles spread over nested folders, plus inventory and playbook of a real host folder
+    rnd = random.Random(0)
+    for i in range(files):
+        role = f'role{i % roles}'
+        dirs = [f'd{rnd.randrange(4)}' for _ in range(rnd.randrange(depth + 1))]
+        name = os.path.join(path, 'roles', role, 'files', *dirs, f'file{i}.txt')
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, 'wb') as f:
+            f.write(os.urandom(rnd.randint(size // 2, size * 3 // 2) if size else 0))
+    for i in range(roles):
+        os.makedirs(os.path.join(path, 'roles', f'role{i}', 'tasks'), exist_ok=True)
+        with open(os.path.join(path, 'roles', f'role{i}', 'tasks', 'main.yaml'), 'w') as f:
+            f.write(f'- debug:\n    msg: role{i}\n')
+    with open(os.path.join(path, 'hosts'), 'w') as f:
+        f.write(f'[bench]\n{HOSTNAME} ansible_connection=local ansible_python_interpreter={sys.executable}\n')
+    with open(os.path.join(path, 'site.yaml'), 'w') as f:
+        f.write('- hosts: all\n  gather_facts: false\n  tasks:\n' + ''.join(f'    - debug:\n        msg: task{i}\n' for i in range(10)))
+
+
+def publish(root, commit):
+    # same metadata ansible-server publishes next to a commit folder
+    path = os.path.join(root, HOSTNAME, commit)
+    write_json(os.path.join(path, '.manifest.json'), build_manifest(path, {}))
+    # roles go to the shared bundle, the rest to the host specific one
+    make_bundle(os.path.join(path, '.bundle.tar.gz'), [(os.path.join(path, 'roles'), 'roles')])
+    make_bundle(os.path.join(path, '.host.tar.gz'), [(os.path.join(path, i), i) for i in sorted(os.listdir(path)) if not i.startswith('.') and i != 'roles'])
+    write_json(os.path.join(root, HOSTNAME, '.latest'), {'commit': commit, 'published': time.time(), 'rollout': {}})
+
+
+def load_agent(workdir, port, workers):
+    # agent reads its config while being imported, so point it to a throwaway one first
+    conf = os.path.join(workdir, 'ansible-agent.conf')
+    with open(conf, 'w') as f:
+        f.write(f'[ansible]\nhostname = {HOSTNAME}\nproject_path = {workdir}/project/\nlog_level = WARNING\n'
+                f'fact_caching = memory\nwarm_worker = false\n'
+                f'[server]\nserver_url = http://127.0.0.1:{port}/\ndownload_workers = {workers}\n'
+                f'[metrics]\nstate_dir = {workdir}/state\n')
+    os.environ['ANSIBLE_AGENT_CONFIG'] = conf
+    spec = importlib.util.spec_from_file_location('agent', AGENT_PATH)
+    agent = importlib.util.module_from_spec(spec)
+    # ansible resolves callback plugins through sys.modules
+    sys.modules['agent'] = agent
+    spec.loader.exec_module(agent)
+    return agent
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(name, server, latencies, func):
+    server.reset()
+    del latencies[:]
+    start = time.time()
+    func()
+    wall = time.time() - start
+    return {
+        'bench': name,
+        'wall_sec': round(wall, 4),
+        'requests': server.requests,
+        'mbytes': round(server.bytes / 2**20, 3),
+        'mbytes_per_sec': round(server.bytes / 2**20 / wall, 3) if wall else 0,
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'latency_p90_ms': round(percentile(latencies, 90) * 1000, 3),
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def touch_files(path, fraction):
+    # modify a fraction of project files, returns their count
+    names = sorted(os.path.join(root, i) for root, dirs, files in os.walk(path) for i in files if '/roles/' in root)
+    changed = names[:max(1, int(len(names) * fraction))]
+    for name in changed:
+        with open(name, 'ab') as f:
+            f.write(b'changed\n')
+    return len(changed)
+
+
+def play(agent, warm):
+    # forked like the agent does it, startup is read back from the run report
+    if warm:
+        agent.warm_ansible()
+    results = []
+    for _ in range(2):
+        start = time.time()
+        p = Process(target=agent.ansible_play, args=(time.time(),))
+        p.start()
+        p.join()
+        with open(os.path.join(agent.STATE_DIR, 'last_run.json')) as f:
+            report = json.load(f)
+        results.append({'bench': 'play-warm' if warm else 'play-cold', 'wall_sec': round(time.time() - start, 4),
+                        'rc': report['rc'], 'startup_sec': round(report['phases'].get('startup', 0), 4),
+                        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of ansible-agent fetch-and-run pipeline')
+    parser.add_argument('mode', choices=['crawl', 'bundle', 'sync', 'detect', 'play', 'all'])
+    parser.add_argument('--files', type=int, default=1000, help='number of files in synthetic project')
+    parser.add_argument('--depth', type=int, default=3, help='max folder depth inside a role')
+    parser.add_argument('--size', type=int, default=4096, help='average file size in bytes')
+    parser.add_argument('--roles', type=int, default=20, help='number of roles')
+    parser.add_argument('--workers', type=int, default=8, help='agent download workers')
+    parser.add_argument('--latency-ms', type=float, default=0, help='artificial server latency per request')
+    parser.add_argument('--changed', type=float, default=0.01, help='fraction of files changed for sync bench')
+    parser.add_argument('--polls', type=int, default=100, help='number of polls for detect bench')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='agent-bench-')
+    try:
+        root = os.path.join(workdir, 'docroot')
+        make_tree(os.path.join(root, HOSTNAME, COMMIT), args.files, args.depth, args.size, args.roles)
+        publish(root, COMMIT)
+        server = BenchServer(root, args.latency_ms / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        agent = load_agent(workdir, server.server_address[1], args.workers)
+
+        latencies = []
+        session = agent.new_session()
+        session.hooks['response'].append(lambda r, *a, **k: latencies.append(r.elapsed.total_seconds()))
+        url = agent.host_url + COMMIT + '/'
+        project = agent.PROJECT_PATH
+        modes = ['crawl', 'bundle', 'sync', 'detect', 'play'] if args.mode == 'all' else [args.mode]
+        results = []
+
+        def fresh():
+            shutil.rmtree(project, True)
+            os.makedirs(project)
+
+        if 'crawl' in modes:
+            fresh()
+            results.append(measure('crawl', server, latencies, lambda: agent.download_url(url, project, session)))
+        if 'bundle' in modes:
+            fresh()
+            results.append(measure('bundle', server, latencies, lambda: agent.download_project(url, project, session)))
+        if 'sync' in modes:
+            fresh()
+            results.append(measure('sync-full', server, latencies, lambda: agent.sync_project(url, project, session)))
+            results.append(measure('sync-noop', server, latencies, lambda: agent.sync_project(url, project, session)))
+            changed = touch_files(os.path.join(root, HOSTNAME, COMMIT), args.changed)
+            publish(root, COMMIT)
+            result = measure('sync-delta', server, latencies, lambda: agent.sync_project(url, project, session))
+            result['changed_files'] = changed
+            results.append(result)
+        if 'detect' in modes:
+            latest = {}
+            def poll():
+                for _ in range(args.polls):
+                    agent.latest_commit(session, latest)
+            results.append(measure('detect', server, latencies, poll))
+        if 'play' in modes:
+            fresh()
+            agent.download_project(url, project, session)
+            results += play(agent, False) + play(agent, True)
+
+        server.shutdown()
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            for result in results:
+                print(' '.join(f'{k}={v}' for k, v in result.items()))
+    finally:
+        shutil.rmtree(workdir, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,31 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+from configparser import ConfigParser
+
+config = ConfigParser()
+config.read(os.environ.get('ANSIBLE_AGENT_CONFIG', '/etc/ansible-agent/ansible-agent.conf'))
+
+# execution profile - ansible picks some of these up while being imported (e.g. default play strategy),
+# so they are exported before importing it. explicit config wins over environment, environment over defaults
+for option, env, default in (('strategy',                   'ANSIBLE_STRATEGY',                 'linear'),
+                             ('gathering',                  'ANSIBLE_GATHERING',                'smart'),
+                             ('fact_caching',               'ANSIBLE_CACHE_PLUGIN',             'jsonfile'),
+                             ('fact_caching_connection',    'ANSIBLE_CACHE_PLUGIN_CONNECTION',  '/root/.ansible-agent/facts'),
+                             ('fact_caching_timeout',       'ANSIBLE_CACHE_PLUGIN_TIMEOUT',     '3600')):
+    if config.has_option('ansible', option):
+        os.environ[env] = config.get('ansible', option)
+    else:
+        os.environ.setdefault(env, default)
+
+# run timings are measured by bundled callback plugin, its folder is added to callback paths (ansible defaults
+# unless set) and the plugin to enabled callbacks
+CALLBACK_PLUGINS_PATH = os.path.join(os.path.dirname(os.path.realpath(sys.executable if getattr(sys, 'frozen', False) else __file__)), 'callback_plugins')
+os.environ['ANSIBLE_CALLBACK_PLUGINS'] = os.pathsep.join([os.environ.get('ANSIBLE_CALLBACK_PLUGINS', '~/.ansible/plugins/callback:/usr/share/ansible/plugins/callback'),
+                                                        config.get('ansible', 'callback_plugins', fallback=CALLBACK_PLUGINS_PATH)])
+os.environ['ANSIBLE_CALLBACKS_ENABLED'] = ','.join(filter(None, [os.environ.get('ANSIBLE_CALLBACKS_ENABLED'), 'ansible_agent_timer']))
+
 import socket
 from ansible.module_utils.common.collections import ImmutableDict
 from ansible.inventory.manager import InventoryManager
@@ -9,24 +35,27 @@ from ansible import context
 from ansible.executor.playbook_executor import PlaybookExecutor
 from ansible.module_utils._text import to_bytes
 from ansible.parsing.vault import VaultSecret
+from ansible.plugins import loader as plugin_loader
 import git
 from git import RemoteProgress
 import shutil
 import time
 from multiprocessing import Process
-import os
-import sys
-from configparser import ConfigParser
 import requests
 import shutil
 import ansible.constants as C
 import fcntl
 import logging
 import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import quote
+import tarfile
+import hashlib
+import yaml
+import threading
+import random
 
 
-config = ConfigParser()
-config.read('/etc/ansible-agent/ansible-agent.conf')
 log_level = config.get('ansible', 'log_level', fallback='INFO')
 logging.basicConfig(format='%(levelname)s: %(message)s', level=getattr(logging, log_level.upper()))
 
@@ -37,9 +66,14 @@ INVENTORY_FILE          = config.get('ansible', 'inventory_file',
 PLAYBOOK                = config.get('ansible', 'playbook',                     fallback='site.yaml')
 TIMER_SCHEDULED_RUN_SEC = int(config.get('ansible', 'timer_scheduled_run_sec',  fallback=1500))
 TIMER_GIT_CHECK_SEC     = int(config.get('ansible', 'timer_git_check_sec',      fallback=30))
+TIMER_GIT_CHECK_JITTER  = float(config.get('ansible', 'timer_git_check_jitter', fallback=0.2))
 SKIP_TAGS               = config.get('ansible', 'skip_tags',                    fallback='').split(',')
 EXTRA_VARS              = { i for i in config.get('ansible', 'extra_vars',      fallback='').split(',') }
 PROJECT_PATH            = config.get('ansible', 'project_path',                 fallback='/root/.ansible-agent/project/')
+WARM_WORKER             = config.getboolean('ansible', 'warm_worker',           fallback=True)
+INCREMENTAL_RUNS        = config.getboolean('ansible', 'incremental_runs',      fallback=False)
+INCREMENTAL_PLAYBOOK    = '.incremental.yaml'
+FORKS                   = int(config.get('ansible', 'forks',                    fallback=20))
 
 #ssl config
 CACERT_BUNDLE           = config.get('ssl', 'ca_cert_bundle_path', fallback=True)
@@ -47,10 +81,20 @@ CACERT_BUNDLE           = config.get('ssl', 'ca_cert_bundle_path', fallback=True
 # git config
 GIT_URL         = config.get('git', 'git_url',          fallback='')
 GIT_BRANCH      = config.get('git', 'git_branch',       fallback='master')
+GIT_DEPTH       = int(config.get('git', 'git_depth',    fallback=1))
 
 #server config
 ANSIBLE_SERVER_URL = config.get('server', 'server_url',  fallback=None)
+DOWNLOAD_WORKERS   = int(config.get('server', 'download_workers',  fallback=8))
+DOWNLOAD_RETRIES   = int(config.get('server', 'download_retries',  fallback=3))
+DOWNLOAD_TIMEOUT   = float(config.get('server', 'download_timeout_sec',  fallback=30))
+DOWNLOAD_CHUNK     = 1024 * 1024
+
 
+# metrics config
+STATE_DIR       = config.get('metrics', 'state_dir',      fallback='/var/lib/ansible-agent')
+TEXTFILE_PATH   = config.get('metrics', 'textfile_path',  fallback=f'{STATE_DIR}/ansible-agent.prom')
+SLOWEST_TASKS   = int(config.get('metrics', 'slowest_tasks', fallback=10))
 
 # alerts config
 ALERT_USER      = config.get('alerts', 'alert_user',     fallback='')
@@ -61,10 +105,9 @@ ALERT_URL       = config.get('alerts', 'alert_url',      fallback='')
 
 lock_file = '/tmp/ansible-agent.lock'
 
-
-if os.path.exists(PROJECT_PATH):
-    shutil.rmtree(PROJECT_PATH)
-os.makedirs(PROJECT_PATH)
+# bytes and files downloaded by the current sync, updated from download workers
+download_stats = {'bytes': 0, 'files': 0}
+download_stats_lock = threading.Lock()
 
 
 if ANSIBLE_SERVER_URL is None:
@@ -72,32 +115,400 @@ if ANSIBLE_SERVER_URL is None:
     def update(self, op_code, cur_count, max_count=None, message=''):
         if message:
             logging.info(message)
-  git.Repo.clone_from(GIT_URL, PROJECT_PATH, branch=GIT_BRANCH, progress=CloneProgress(), config='http.sslVerify=false')
+  # workspace survives restarts, clone only if there is no usable one
+  try:
+      repo = git.Repo(PROJECT_PATH)
+      if repo.remotes.origin.url != GIT_URL or repo.active_branch.name != GIT_BRANCH:
+          raise Exception(f'{PROJECT_PATH} tracks {repo.remotes.origin.url} {repo.active_branch.name}')
+      logging.info(f'Reusing git workspace {PROJECT_PATH}')
+  except Exception as e:
+      logging.info(f'Cloning {GIT_BRANCH} into {PROJECT_PATH}: {e}')
+      if os.path.exists(PROJECT_PATH):
+          shutil.rmtree(PROJECT_PATH)
+      os.makedirs(PROJECT_PATH)
+      git.Repo.clone_from(GIT_URL, PROJECT_PATH, branch=GIT_BRANCH, depth=GIT_DEPTH, single_branch=True, progress=CloneProgress(), config='http.sslVerify=false')
 
 else:
+  # project is kept between restarts, sync_project() brings it up to date
+  os.makedirs(PROJECT_PATH, exist_ok=True)
   host_url = ANSIBLE_SERVER_URL  + HOSTNAME + '/'
 
 
 
-def download_url(url, last_hash, session):
-   p_respons  = session.get(url, verify = CACERT_BUNDLE)
-   for p_files in p_respons.json():
-       dir= PROJECT_PATH + url.split(last_hash)[1]
-       if p_files['type'] == 'directory':
-            logging.debug('create dir: ' + dir+ '/' + p_files['name'] )
-            os.makedirs(dir+ '/' + p_files['name'])
-            new_url=url + '/' + p_files['name'] + '/'
-            download_url(new_url, last_hash, session)
-       elif p_files['type'] == 'file':
-            files = session.get(url + '/' + p_files['name'], verify = CACERT_BUNDLE)
-            logging.debug('create file: ' + dir + '/'  + p_files['name'] )
-            with open(dir + '/'  + p_files['name'], 'wb') as f:
-               f.write(files.content)
+def new_session():
+    # keep-alive pool sized to the number of download workers, so parallel requests reuse connections
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=DOWNLOAD_WORKERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_with_retry(session, url):
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            resp = session.get(url, verify = CACERT_BUNDLE, timeout = DOWNLOAD_TIMEOUT)
+            resp.raise_for_status()
+            return resp
+        except requests.RequestException as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logging.warning(f'GET {url} failed ({attempt}/{DOWNLOAD_RETRIES}), retrying: {e}')
+            time.sleep(attempt)
+
+
+def count_download(nbytes, nfiles=1):
+    with download_stats_lock:
+        download_stats['bytes'] += nbytes
+        download_stats['files'] += nfiles
+
+
+def fetch_file(session, url, path):
+    # stream in chunks to a .part file and rename it when complete, so memory stays flat regardless of file size,
+    # and retries continue an interrupted transfer with a Range request instead of starting over
+    part = path + '.part'
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        try:
+            with session.get(url, headers = headers, verify = CACERT_BUNDLE, stream = True, timeout = DOWNLOAD_TIMEOUT) as resp:
+                if resp.status_code == 416:
+                    # part is complete or stale, start over
+                    os.remove(part)
+                resp.raise_for_status()
+                if offset and resp.status_code == 206:
+                    logging.debug(f'resume {path} from {offset}')
+                with open(part, 'ab' if resp.status_code == 206 else 'wb') as f:
+                    for chunk in resp.iter_content(DOWNLOAD_CHUNK):
+                        f.write(chunk)
+                        count_download(len(chunk), 0)
+            logging.debug('create file: ' + path)
+            os.replace(part, path)
+            count_download(0)
+            return
+        except requests.RequestException as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logging.warning(f'GET {url} failed ({attempt}/{DOWNLOAD_RETRIES}), retrying: {e}')
+            time.sleep(attempt)
+
+
+def download_url(url, path, session):
+    # crawl nginx autoindex listings and download files through a bounded pool of workers,
+    # so listings of subfolders and files are fetched at the same time instead of one by one
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        pending = {pool.submit(get_with_retry, session, url.rstrip('/') + '/'): (url.rstrip('/'), path.rstrip('/'))}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                p_url, p_dir = pending.pop(future)
+                try:
+                    p_respons = future.result()
+                except Exception:
+                    for other in pending:
+                        other.cancel()
+                    raise
+                if p_respons is None:
+                    # finished file download
+                    continue
+                for p_files in p_respons.json():
+                    if p_files['type'] == 'directory':
+                        logging.debug('create dir: ' + p_dir + '/' + p_files['name'])
+                        os.makedirs(p_dir + '/' + p_files['name'])
+                        new_url = p_url + '/' + quote(p_files['name'])
+                        pending[pool.submit(get_with_retry, session, new_url + '/')] = (new_url, p_dir + '/' + p_files['name'])
+                    elif p_files['type'] == 'file':
+                        new_url = p_url + '/' + quote(p_files['name'])
+                        pending[pool.submit(fetch_file, session, new_url, p_dir + '/' + p_files['name'])] = (new_url, p_dir)
 
  
-def ansible_play():
+def fetch_bundle(session, url, path):
+    # stream tar.gz straight into project folder, returns False if server doesn't publish this archive
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            resp = session.get(url, verify = CACERT_BUNDLE, stream = True, timeout = DOWNLOAD_TIMEOUT)
+            if resp.status_code == 404:
+                return False
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            with tarfile.open(fileobj=resp.raw, mode='r|gz') as tar:
+                for member in tar:
+                    if (member.name.startswith('/') or '..' in member.name.split('/') or
+                        not (member.isfile() or member.isdir())):
+                        raise Exception(f'unexpected member {member.name} in {url}')
+                    logging.debug('extract: ' + path + '/' + member.name)
+                    tar.extract(member, path)
+                    if member.isfile():
+                        count_download(member.size)
+            return True
+        except (requests.RequestException, tarfile.TarError, EOFError, OSError) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logging.warning(f'GET {url} failed ({attempt}/{DOWNLOAD_RETRIES}), retrying: {e}')
+            time.sleep(attempt)
+
+
+def download_project(url, path, session):
+    # shared bundle and host specific bundle are two streaming requests regardless of project size,
+    # crawling listings is kept as fallback for servers that don't publish bundles
+    if fetch_bundle(session, url.rstrip('/') + '/.bundle.tar.gz', path):
+        fetch_bundle(session, url.rstrip('/') + '/.host.tar.gz', path)
+    else:
+        download_url(url, path, session)
 
-    context.CLIARGS = ImmutableDict(connection='local', forks=20, become=None,
+
+def sha256(file):
+    sha256_hash = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            sha256_hash.update(chunk)
+    return sha256_hash.hexdigest()
+
+
+def local_manifest(path):
+    # {relative path: sha256} of the project folder, skipping top level dot-files the agent keeps for itself
+    manifest = {}
+    for root, dirs, files in os.walk(path):
+        if os.path.normpath(root) == os.path.normpath(path):
+            files = [i for i in files if not i.startswith('.')]
+            dirs[:] = [i for i in dirs if not i.startswith('.')]
+        for name in files:
+            manifest[os.path.relpath(os.path.join(root, name), path)] = sha256(os.path.join(root, name))
+    return manifest
+
+
+def sync_project(url, path, session):
+    # diff server manifest against local copy, download only changed and added files to a staging folder,
+    # and swap them in only after all of them arrived, so a failed sync never leaves a half updated project.
+    # returns changed and removed paths, or None after a full download
+    url = url.rstrip('/')
+    path = path.rstrip('/')
+    resp = session.get(url + '/.manifest.json', verify = CACERT_BUNDLE, timeout = DOWNLOAD_TIMEOUT)
+    if resp.status_code == 404 or not os.listdir(path):
+        # server without manifests or nothing to diff against - full download
+        logging.info(f'Full download of {url}')
+        shutil.rmtree(path)
+        os.makedirs(path)
+        download_project(url, path, session)
+        return None
+    resp.raise_for_status()
+    manifest = resp.json()
+    local = local_manifest(path)
+    changed = sorted(i for i in manifest if local.get(i) != manifest[i]['sha256'])
+    removed = sorted(i for i in local if i not in manifest)
+    logging.info(f'Syncing {url}: {len(changed)} changed, {len(removed)} removed, {len(manifest) - len(changed)} unchanged files')
+
+    # staging folder is kept when sync fails, so next attempt reuses files that already arrived
+    # and resumes partial ones
+    staging = path + '.staging'
+    os.makedirs(staging, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        futures = []
+        for i in changed:
+            if os.path.isfile(f'{staging}/{i}') and sha256(f'{staging}/{i}') == manifest[i]['sha256']:
+                continue
+            os.makedirs(os.path.dirname(f'{staging}/{i}'), exist_ok=True)
+            futures.append(pool.submit(fetch_file, session, url + '/' + quote(i), f'{staging}/{i}'))
+        for future in futures:
+            future.result()
+    for i in changed:
+        if sha256(f'{staging}/{i}') != manifest[i]['sha256']:
+            os.remove(f'{staging}/{i}')
+            raise Exception(f'checksum mismatch for {i}')
+    for i in removed:
+        logging.debug('remove file: ' + path + '/' + i)
+        os.remove(f'{path}/{i}')
+    for i in changed:
+        if os.path.isdir(f'{path}/{i}'):
+            shutil.rmtree(f'{path}/{i}')
+        os.makedirs(os.path.dirname(f'{path}/{i}'), exist_ok=True)
+        os.replace(f'{staging}/{i}', f'{path}/{i}')
+    for root, dirs, files in os.walk(path, topdown=False):
+        if root != path and not os.listdir(root):
+            os.rmdir(root)
+    shutil.rmtree(staging, True)
+    return set(changed) | set(removed)
+
+
+def latest_commit(session, latest):
+    # poll small .latest pointer with If-None-Match, so an unchanged commit costs an empty 304 response,
+    # servers without the pointer are handled by listing and sorting the host folder
+    headers = {'If-None-Match': latest['etag']} if latest.get('etag') else {}
+    resp = session.get(host_url + '.latest', headers = headers, verify = CACERT_BUNDLE, timeout = DOWNLOAD_TIMEOUT)
+    if resp.status_code == 304:
+        return latest['commit']
+    if resp.status_code == 200:
+        latest.update(resp.json())
+        latest['etag'] = resp.headers.get('ETag')
+        return latest['commit']
+    if resp.status_code != 404:
+        resp.raise_for_status()
+    a = session.get(host_url, verify = CACERT_BUNDLE, timeout = DOWNLOAD_TIMEOUT)
+    a.raise_for_status()
+    all_commit={}
+    for hash in a.json():
+      if hash['name'] != 'ansiblectl':
+        all_commit[hash['name'].split("_")[0]] = hash['name']
+    sort_dict_hash = dict(sorted(all_commit.items()))
+    return sort_dict_hash[list(sort_dict_hash.keys())[-1]]
+
+
+def rollout_delay(rollout):
+    # seconds after publishing when this host's turn comes, slot is derived from hostname,
+    # so every host gets the same slot on every commit and hosts spread evenly over the plan
+    slot = int(hashlib.sha256(HOSTNAME.encode()).hexdigest(), 16) / 2**256
+    if rollout.get('waves'):
+        return int(slot * rollout['waves']) * rollout.get('wave_interval_sec', 0)
+    return slot * rollout.get('window_sec', 0)
+
+
+def play_roles(items):
+    # names of roles a list of plays/tasks refers to, '*' if a name is templated and can't be resolved
+    roles = set()
+    if isinstance(items, dict):
+        for key, value in items.items():
+            if key == 'roles' and isinstance(value, list):
+                for role in value:
+                    roles.add(role.get('role', role.get('name')) if isinstance(role, dict) else role)
+            elif str(key).split('.')[-1] in ('include_role', 'import_role') and isinstance(value, dict):
+                roles.add(value.get('name'))
+            else:
+                roles |= play_roles(value)
+    elif isinstance(items, list):
+        for item in items:
+            roles |= play_roles(item)
+    return set('*' if not isinstance(i, str) or '{{' in i else i for i in roles)
+
+
+def role_dependencies(role, seen):
+    # role itself plus roles it pulls in through meta dependencies and include_role/import_role
+    if role in seen or role == '*':
+        return seen | {role}
+    seen = seen | {role}
+    for root, dirs, files in os.walk(f'{PROJECT_PATH}/roles/{role}'):
+        if os.path.basename(root) in ('meta', 'tasks', 'handlers'):
+            for name in files:
+                if name.endswith(('.yml', '.yaml')):
+                    with open(os.path.join(root, name)) as f:
+                        content = yaml.safe_load(f)
+                    deps = play_roles(content)
+                    if os.path.basename(root) == 'meta' and isinstance(content, dict):
+                        deps |= play_roles({'roles': content.get('dependencies') or []})
+                    for dep in deps:
+                        seen = role_dependencies(dep, seen)
+    return seen
+
+
+def incremental_playbook(changed):
+    # playbook to run for a commit that changed given paths: PLAYBOOK if every play may be affected,
+    # INCREMENTAL_PLAYBOOK with affected plays only, or None if no play is affected
+    changed_roles = set()
+    for path in changed:
+        parts = path.split('/')
+        if parts[0] != 'roles' or len(parts) < 3:
+            # inventory, group_vars, host_vars or playbook itself - host vars apply to every play
+            logging.info(f'{path} changed, running all plays')
+            return PLAYBOOK
+        changed_roles.add(parts[1])
+    with open(PROJECT_PATH + PLAYBOOK) as f:
+        plays = yaml.safe_load(f)
+    affected = []
+    for play in plays:
+        roles = set()
+        for role in play_roles(play):
+            roles = role_dependencies(role, roles)
+        if '*' in roles or roles & changed_roles:
+            affected.append(play)
+    logging.info(f'roles changed: {sorted(changed_roles)}, plays affected: {len(affected)} of {len(plays)}')
+    if not affected:
+        return None
+    if len(affected) == len(plays):
+        return PLAYBOOK
+    with open(PROJECT_PATH + INCREMENTAL_PLAYBOOK, 'w') as f:
+        yaml.safe_dump(affected, f, sort_keys=False)
+    return INCREMENTAL_PLAYBOOK
+
+
+def warm_ansible():
+    # import and index plugins once in the long living parent, every forked run inherits them
+    # instead of scanning plugin paths and importing plugins before its first task
+    started = time.time()
+    if hasattr(plugin_loader, 'init_plugin_loader'):
+        plugin_loader.init_plugin_loader()
+    for name in ('action_loader', 'callback_loader', 'connection_loader', 'strategy_loader', 'lookup_loader',
+                 'filter_loader', 'test_loader', 'become_loader', 'shell_loader', 'cache_loader'):
+        try:
+            list(getattr(plugin_loader, name).all(class_only=True))
+        except Exception as e:
+            logging.debug(f'Failed to preload {name}: {e}')
+    plugin_loader.module_loader.find_plugin('setup')
+    logging.info(f'ansible plugins preloaded in {time.time() - started:.2f}s')
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_report(report):
+    # json run report for humans/tools and textfile for node_exporter textfile collector, both replaced atomically
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(f'{STATE_DIR}/last_run.json.tmp', 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(f'{STATE_DIR}/last_run.json.tmp', f'{STATE_DIR}/last_run.json')
+
+    trigger = prometheus_label(report['trigger'])
+    lines = [
+        '# HELP ansible_agent_run_timestamp_seconds Time the last run was triggered.',
+        '# TYPE ansible_agent_run_timestamp_seconds gauge',
+        f'ansible_agent_run_timestamp_seconds{{trigger="{trigger}"}} {report["triggered"]:.3f}',
+        '# HELP ansible_agent_run_rc Return code of the last run.',
+        '# TYPE ansible_agent_run_rc gauge',
+        f'ansible_agent_run_rc{{trigger="{trigger}"}} {report["rc"]}',
+        '# HELP ansible_agent_phase_duration_seconds Duration of phases of the last run.',
+        '# TYPE ansible_agent_phase_duration_seconds gauge',
+    ] + [
+        f'ansible_agent_phase_duration_seconds{{trigger="{trigger}",phase="{prometheus_label(k)}"}} {v:.3f}' for k, v in sorted(report['phases'].items())
+    ]
+    if 'download' in report:
+        lines += [
+            '# HELP ansible_agent_download_bytes Bytes downloaded for the last commit.',
+            '# TYPE ansible_agent_download_bytes gauge',
+            f'ansible_agent_download_bytes {report["download"]["bytes"]}',
+            '# HELP ansible_agent_download_files Files downloaded for the last commit.',
+            '# TYPE ansible_agent_download_files gauge',
+            f'ansible_agent_download_files {report["download"]["files"]}',
+        ]
+    if 'commit_to_run' in report:
+        lines += [
+            '# HELP ansible_agent_commit_to_run_seconds Time from new commit detection to first task of the run.',
+            '# TYPE ansible_agent_commit_to_run_seconds gauge',
+            f'ansible_agent_commit_to_run_seconds {report["commit_to_run"]:.3f}',
+        ]
+    lines += [
+        '# HELP ansible_agent_role_duration_seconds Total duration of tasks of a role in the last run.',
+        '# TYPE ansible_agent_role_duration_seconds gauge',
+    ] + [
+        f'ansible_agent_role_duration_seconds{{trigger="{trigger}",role="{prometheus_label(k)}"}} {v:.3f}' for k, v in sorted(report['roles'].items())
+    ] + [
+        '# HELP ansible_agent_slowest_task_duration_seconds Duration of the slowest tasks in the last run.',
+        '# TYPE ansible_agent_slowest_task_duration_seconds gauge',
+    ] + [
+        f'ansible_agent_slowest_task_duration_seconds{{trigger="{trigger}",rank="{i}",role="{prometheus_label(t["role"])}",task="{prometheus_label(t["task"])}"}} {t["duration"]:.3f}'
+        for i, t in enumerate(report['slowest_tasks'], 1)
+    ]
+    os.makedirs(os.path.dirname(TEXTFILE_PATH), exist_ok=True)
+    with open(f'{TEXTFILE_PATH}.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(f'{TEXTFILE_PATH}.tmp', TEXTFILE_PATH)
+
+
+def ansible_play(triggered, playbook=PLAYBOOK, report=None):
+    # report carries trigger and phases measured by caller, completed here and written to STATE_DIR
+    report = dict(report or {'trigger': 'schedule', 'phases': {}}, triggered=triggered, playbook=playbook)
+
+    context.CLIARGS = ImmutableDict(connection='local', forks=FORKS, become=None,
                                     become_method='sudo', become_user='root', check=False, diff=False, verbosity=True,
                                     syntax=False, listhosts=False, listtasks=False, listtags=False, start_at_task=None, skip_tags=SKIP_TAGS, extra_vars=EXTRA_VARS)
     loader = DataLoader()  # Takes care of finding and reading yaml, json and ini files
@@ -106,11 +517,41 @@ def ansible_play():
     inventory = InventoryManager(loader=loader, sources=PROJECT_PATH + INVENTORY_FILE)
     inventory.subset([HOSTNAME])
     variable_manager = VariableManager(loader=loader, inventory=inventory)
-    playbooks = [PROJECT_PATH + PLAYBOOK]
+    playbooks = [PROJECT_PATH + playbook]
     executor = PlaybookExecutor(playbooks=playbooks, inventory=inventory,
                                 variable_manager=variable_manager, loader=loader, passwords=passwords)
+    logging.debug(f'execution profile: forks={FORKS} strategy={C.DEFAULT_STRATEGY} gathering={C.DEFAULT_GATHERING} '
+                  f'fact_caching={C.CACHE_PLUGIN} timeout={C.CACHE_PLUGIN_TIMEOUT}')
+    report['phases']['setup'] = time.time() - triggered
+    # ansible_agent_timer callback plugin gets trigger time and writes timings of this run to STATE_DIR
+    os.makedirs(STATE_DIR, exist_ok=True)
+    os.environ['ANSIBLE_AGENT_TRIGGERED'] = str(triggered)
+    os.environ['ANSIBLE_AGENT_TIMINGS'] = f'{STATE_DIR}/timings.json'
+    if os.path.exists(f'{STATE_DIR}/timings.json'):
+        os.remove(f'{STATE_DIR}/timings.json')
     rc = executor.run()
     shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
+
+    report['rc'] = rc
+    report['phases']['ansible'] = time.time() - triggered
+    timings = {'first_task': None, 'tasks': []}
+    try:
+        with open(f'{STATE_DIR}/timings.json') as f:
+            timings = json.load(f)
+    except Exception as e:
+        logging.warning(f'No task timings from ansible_agent_timer callback plugin: {e}')
+    if timings['first_task'] is not None:
+        report['phases']['startup'] = timings['first_task'] - triggered
+        if 'detected' in report:
+            report['commit_to_run'] = timings['first_task'] - report['detected']
+    report['roles'] = {}
+    for task in timings['tasks']:
+        report['roles'][task['role']] = report['roles'].get(task['role'], 0) + task['duration']
+    report['slowest_tasks'] = sorted(timings['tasks'], key=lambda i: i['duration'], reverse=True)[:SLOWEST_TASKS]
+    try:
+        write_report(report)
+    except Exception as e:
+        logging.error(f'Failed to write run report to {STATE_DIR}: {e}')
     if rc != 0:
         logging.error(f'playbook executor run return code: {rc}')
         if ALERT_URL:
@@ -123,32 +564,29 @@ def ansible_play():
 def run_on_commit():
   
     lock = open(lock_file, 'w')
+    # .latest pointer of ansible-server, stays empty when pulling from git
+    latest = {}
     if ANSIBLE_SERVER_URL is None:
        repo = git.Repo(PROJECT_PATH)
        git_cmd = git.cmd.Git(PROJECT_PATH)
        repo.git.checkout(GIT_BRANCH)
        current_hash = repo.head.object.hexsha
     else:
-       session = requests.Session()
-       a = session.get(host_url, verify = CACERT_BUNDLE)
-       if a.status_code == 200:
-          all_commit={}
-          for hash in a.json():
-            if hash['name'] != 'ansiblectl':
-              all_commit[hash['name'].split("_")[0]] = hash['name']
-          sort_dict_hash = dict(sorted(all_commit.items()))
-          current_hash = sort_dict_hash[list(sort_dict_hash.keys())[-1]]
-          roles_url= host_url + '/' + current_hash
-          try:
-            download_url(roles_url, current_hash, session)
-          except:
-            logging.error('''Can't Download roles for host''')
-            sys.exit(1)
-       else:
-          logging.error('''Can't get  commit hash''')
+       session = new_session()
+       try:
+          current_hash = latest_commit(session, latest)
+       except Exception as e:
+          logging.error(f'''Can't get  commit hash: {e}''')
           sys.exit(1)
+       roles_url= host_url + '/' + current_hash
+       try:
+         sync_project(roles_url, PROJECT_PATH, session)
+       except Exception as e:
+         logging.error(f'''Can't Download roles for host: {e}''')
+         sys.exit(1)
     while True:
-        time.sleep(TIMER_GIT_CHECK_SEC)
+        # jitter keeps agents started at the same time from polling in lockstep
+        time.sleep(TIMER_GIT_CHECK_SEC * random.uniform(1 - TIMER_GIT_CHECK_JITTER, 1 + TIMER_GIT_CHECK_JITTER))
         try:
             fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except (IOError, OSError):
@@ -156,39 +594,64 @@ def run_on_commit():
         else:
             try:
                if ANSIBLE_SERVER_URL is None: 
-                 git_cmd.pull()
+                 pull_started = time.time()
+                 # cheap ref check first, fetch only when branch moved
+                 remote_hash = git_cmd.ls_remote('origin', f'refs/heads/{GIT_BRANCH}').split()[0]
+                 if remote_hash != current_hash:
+                     git_cmd.fetch(f'--depth={GIT_DEPTH}', 'origin', GIT_BRANCH)
+                     git_cmd.reset('--hard', 'FETCH_HEAD')
+                 phases = {'pull': time.time() - pull_started}
                  new_hash = repo.head.object.hexsha
                else:
-                 logging.info('start check new commit from ansible-servers')
-                 a = session.get(host_url, verify = CACERT_BUNDLE)
-                 if a.status_code == 200:
-                    all_commit={}
-                    for hash in a.json():
-                      if hash['name'] != 'ansiblectl':
-                        all_commit[hash['name'].split("_")[0]] = hash['name']
-                    sort_dict_hash = dict(sorted(all_commit.items()))
-                    new_hash = sort_dict_hash[list(sort_dict_hash.keys())[-1]]
-                 else:
-                    logging.error('''Can't get  commit hash''')
-                    continue
+                 logging.debug('start check new commit from ansible-servers')
+                 check_started = time.time()
+                 new_hash = latest_commit(session, latest)
+                 phases = {'detect': time.time() - check_started}
             except Exception as e:
                 logging.error(f'Failed running git pull or get from ansible-server: {e}, line {sys.exc_info()[-1].tb_lineno}')
+                new_hash = current_hash
+            if new_hash != current_hash and ANSIBLE_SERVER_URL is not None and latest.get('rollout'):
+                # slot counts from the first commit host deferred, so commits landing more often than the rollout
+                # window don't push late slots back forever
+                start_at = latest.setdefault('deferred_since', latest['published']) + rollout_delay(latest['rollout'])
+                if time.time() < start_at:
+                    if latest.get('deferred') != new_hash:
+                        logging.info(f'New commit: {new_hash}, waiting for rollout slot in {start_at - time.time():.0f}s')
+                        latest['deferred'] = new_hash
+                    new_hash = current_hash
             if new_hash != current_hash:
+                report = {'trigger': 'commit', 'commit': new_hash, 'detected': time.time(), 'phases': {}}
+                report['phases'].update(phases)
+                changed = None
                 if ANSIBLE_SERVER_URL is not None:
-                   if os.path.exists(PROJECT_PATH):
-                      shutil.rmtree(PROJECT_PATH)
-                      os.makedirs(PROJECT_PATH)
                    roles_url= host_url + '/' + new_hash
                    try:
-                     download_url(roles_url, new_hash, session)
-                   except:
-                     logging.error('''Can't Download roles for host''')
+                     download_started = time.time()
+                     download_stats.update(bytes=0, files=0)
+                     changed = sync_project(roles_url, PROJECT_PATH, session)
+                     report['phases']['download'] = time.time() - download_started
+                     report['download'] = dict(download_stats)
+                   except Exception as e:
+                     logging.error(f'''Can't Download roles for host: {e}''')
                      continue
-                logging.info(f'Running ansible for a new commit: {new_hash}')
-                process = Process(target=ansible_play)
-                process.start()
-                process.join()
+                playbook = PLAYBOOK
+                if INCREMENTAL_RUNS:
+                    try:
+                        if ANSIBLE_SERVER_URL is None:
+                            changed = set(repo.git.diff('--name-only', current_hash, new_hash).splitlines())
+                        if changed is not None:
+                            playbook = incremental_playbook(changed)
+                    except Exception as e:
+                        logging.error(f'Failed to select affected plays, running all plays: {e}')
+                if playbook is None:
+                    logging.info(f'No plays affected by a new commit: {new_hash}, skipping run')
+                else:
+                    logging.info(f'Running ansible for a new commit: {new_hash}')
+                    process = Process(target=ansible_play, args=(time.time(), playbook, report))
+                    process.start()
+                    process.join()
                 current_hash = new_hash
+                latest.pop('deferred_since', None)
             fcntl.flock(lock, fcntl.LOCK_UN)
     lock.close()
 
@@ -203,7 +666,7 @@ def run_on_schedule():
             logging.debug("run_on_schedule() could'n acquire lock - must be run_on_commit() holding the lock")
         else:
             logging.info('Running ansible on schedule')
-            process = Process(target=ansible_play)
+            process = Process(target=ansible_play, args=(time.time(),))
             process.start()
             process.join()
             fcntl.flock(lock, fcntl.LOCK_UN)
@@ -212,6 +675,8 @@ def run_on_schedule():
 
 if __name__ == '__main__':
     logging.debug('Start execution')
+    if WARM_WORKER:
+        warm_ansible()
     p1 = Process(target=run_on_commit)
     p1.start()
     p2 = Process(target=run_on_schedule)
@@ -24,6 +24,9 @@ import fcntl
 import logging
 import argparse
 import signal
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import quote
+import tarfile
 
 os.environ["ANSIBLE_COLLECTIONS_PATH"] = "/usr/local/lib/python3.6/site-packages/ansible_collections/"
 os.system('export ANSIBLE_COLLECTIONS_PATH=/usr/local/lib/python3.6/site-packages/ansible_collections/')
@@ -60,25 +63,129 @@ GIT_BRANCH      = args.branch
 
 #server config
 ANSIBLE_SERVER_URL = config.get('server', 'server_url',  fallback=None)
+DOWNLOAD_WORKERS   = int(config.get('server', 'download_workers',  fallback=8))
+DOWNLOAD_RETRIES   = int(config.get('server', 'download_retries',  fallback=3))
+DOWNLOAD_TIMEOUT   = float(config.get('server', 'download_timeout_sec',  fallback=30))
+DOWNLOAD_CHUNK     = 1024 * 1024
 
 
 lock_file = '/tmp/ansiblectl.lock'
 
 
-def download_url(url, last_hash, session):
-   p_respons  = session.get(url, verify = CACERT_BUNDLE)
-   for p_files in p_respons.json():
-       dir= PROJECT_PATH + url.split(last_hash)[1]
-       if p_files['type'] == 'directory':
-            logging.debug('create dir: ' + dir+ '/' + p_files['name'] )
-            os.makedirs(dir+ '/' + p_files['name'])
-            new_url=url + '/' + p_files['name'] + '/'
-            download_url(new_url, last_hash, session)
-       elif p_files['type'] == 'file':
-            files = session.get(url + '/' + p_files['name'], verify = CACERT_BUNDLE)
-            logging.debug('create file: ' + dir + '/'  + p_files['name'] )
-            with open(dir + '/'  + p_files['name'], 'wb') as f:
-               f.write(files.content)
+def new_session():
+    # keep-alive pool sized to the number of download workers, so parallel requests reuse connections
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=DOWNLOAD_WORKERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_with_retry(session, url):
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            resp = session.get(url, verify = CACERT_BUNDLE, timeout = DOWNLOAD_TIMEOUT)
+            resp.raise_for_status()
+            return resp
+        except requests.RequestException as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logging.warning(f'GET {url} failed ({attempt}/{DOWNLOAD_RETRIES}), retrying: {e}')
+            time.sleep(attempt)
+
+
+def fetch_file(session, url, path):
+    # stream in chunks to a .part file and rename it when complete, so memory stays flat regardless of file size,
+    # and retries continue an interrupted transfer with a Range request instead of starting over
+    part = path + '.part'
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        try:
+            with session.get(url, headers = headers, verify = CACERT_BUNDLE, stream = True, timeout = DOWNLOAD_TIMEOUT) as resp:
+                if resp.status_code == 416:
+                    # part is complete or stale, start over
+                    os.remove(part)
+                resp.raise_for_status()
+                if offset and resp.status_code == 206:
+                    logging.debug(f'resume {path} from {offset}')
+                with open(part, 'ab' if resp.status_code == 206 else 'wb') as f:
+                    for chunk in resp.iter_content(DOWNLOAD_CHUNK):
+                        f.write(chunk)
+            logging.debug('create file: ' + path)
+            os.replace(part, path)
+            return
+        except requests.RequestException as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logging.warning(f'GET {url} failed ({attempt}/{DOWNLOAD_RETRIES}), retrying: {e}')
+            time.sleep(attempt)
+
+
+def download_url(url, path, session):
+    # crawl nginx autoindex listings and download files through a bounded pool of workers,
+    # so listings of subfolders and files are fetched at the same time instead of one by one
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        pending = {pool.submit(get_with_retry, session, url.rstrip('/') + '/'): (url.rstrip('/'), path.rstrip('/'))}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                p_url, p_dir = pending.pop(future)
+                try:
+                    p_respons = future.result()
+                except Exception:
+                    for other in pending:
+                        other.cancel()
+                    raise
+                if p_respons is None:
+                    # finished file download
+                    continue
+                for p_files in p_respons.json():
+                    if p_files['type'] == 'directory':
+                        logging.debug('create dir: ' + p_dir + '/' + p_files['name'])
+                        os.makedirs(p_dir + '/' + p_files['name'])
+                        new_url = p_url + '/' + quote(p_files['name'])
+                        pending[pool.submit(get_with_retry, session, new_url + '/')] = (new_url, p_dir + '/' + p_files['name'])
+                    elif p_files['type'] == 'file':
+                        new_url = p_url + '/' + quote(p_files['name'])
+                        pending[pool.submit(fetch_file, session, new_url, p_dir + '/' + p_files['name'])] = (new_url, p_dir)
+
+ 
+
+
+def fetch_bundle(session, url, path):
+    # stream tar.gz straight into project folder, returns False if server doesn't publish this archive
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            resp = session.get(url, verify = CACERT_BUNDLE, stream = True, timeout = DOWNLOAD_TIMEOUT)
+            if resp.status_code == 404:
+                return False
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            with tarfile.open(fileobj=resp.raw, mode='r|gz') as tar:
+                for member in tar:
+                    if (member.name.startswith('/') or '..' in member.name.split('/') or
+                        not (member.isfile() or member.isdir())):
+                        raise Exception(f'unexpected member {member.name} in {url}')
+                    logging.debug('extract: ' + path + '/' + member.name)
+                    tar.extract(member, path)
+            return True
+        except (requests.RequestException, tarfile.TarError, EOFError, OSError) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logging.warning(f'GET {url} failed ({attempt}/{DOWNLOAD_RETRIES}), retrying: {e}')
+            time.sleep(attempt)
+
+
+def download_project(url, path, session):
+    # shared bundle and host specific bundle are two streaming requests regardless of project size,
+    # crawling listings is kept as fallback for servers that don't publish bundles
+    if fetch_bundle(session, url.rstrip('/') + '/.bundle.tar.gz', path):
+        fetch_bundle(session, url.rstrip('/') + '/.host.tar.gz', path)
+    else:
+        download_url(url, path, session)
 
 
 def ansible_play(check=False, diff=False):
@@ -130,23 +237,22 @@ if args.run:
             def update(self, op_code, cur_count, max_count=None, message=''):
                 if message:
                     logging.info(message)
-        git.Repo.clone_from(GIT_URL, PROJECT_PATH, branch=GIT_BRANCH, progress=CloneProgress(), config='http.sslVerify=false')
+        git.Repo.clone_from(GIT_URL, PROJECT_PATH, branch=GIT_BRANCH, depth=1, single_branch=True, progress=CloneProgress(), config='http.sslVerify=false')
         repo = git.Repo(PROJECT_PATH)
         repo.git.checkout(GIT_BRANCH)
     
     else:
-        session = requests.Session()
+        session = new_session()
         data = {"host": HOSTNAME, "branch": GIT_BRANCH}
         logging.info(f"HTTP POST {ANSIBLE_SERVER_URL}/ansiblectl: {data}")
         resp = session.post(f"{ANSIBLE_SERVER_URL}/ansiblectl", json = data, verify = CACERT_BUNDLE)
         if resp.status_code == 200:
             # get last url in request
             roles_url = resp.request.url
-            hash = roles_url.rstrip('/').split('/')[-1]
             try:
                 logging.info(f"Downloading from: {roles_url}")
-                download_url(roles_url, hash, session)
-            except:
+                download_project(roles_url, PROJECT_PATH, session)
+            except Exception as e:
                 logging.fatal(f'Download failed: {e}, line {sys.exc_info()[-1].tb_lineno}')
                 sys.exit(1)
         else:
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# callback plugin of ansible-agent - measures time from run being triggered to its first task, and duration of
+# every task. ansible-agent adds this folder to ANSIBLE_CALLBACK_PLUGINS, enables the plugin in
+# ANSIBLE_CALLBACKS_ENABLED and passes trigger time and path of the timings file in environment
+
+DOCUMENTATION = '''
+    name: ansible_agent_timer
+    type: aggregate
+    short_description: run timings for ansible-agent
+    description:
+      - Writes time of the first task and duration of every task to json file ANSIBLE_AGENT_TIMINGS,
+        ansible-agent turns them into its run report.
+    requirements:
+      - enabled in callbacks_enabled, ansible-agent does it
+'''
+
+import os
+import json
+import time
+import logging
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'ansible_agent_timer'
+    CALLBACK_NEEDS_ENABLED = True
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self):
+        super().__init__()
+        self.triggered = float(os.environ.get('ANSIBLE_AGENT_TRIGGERED', time.time()))
+        self.path = os.environ.get('ANSIBLE_AGENT_TIMINGS')
+        self.first_task = None
+        self.current = None
+        self.tasks = []
+
+    def close_task(self):
+        if self.current is not None:
+            name, role, started = self.current
+            self.tasks.append({'task': name, 'role': role, 'duration': time.time() - started})
+            self.current = None
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.close_task()
+        if self.first_task is None:
+            self.first_task = time.time()
+            logging.info(f'ansible startup took {self.first_task - self.triggered:.2f}s')
+        self.current = (task.get_name(), task._role.get_name() if task._role else '', time.time())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.v2_playbook_on_task_start(task, False)
+
+    def v2_playbook_on_play_start(self, play):
+        self.close_task()
+
+    def v2_playbook_on_stats(self, stats):
+        self.close_task()
+        if self.path:
+            # written via rename, agent never reads a half written file
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'first_task': self.first_task, 'tasks': self.tasks}, f)
+            os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# scaling check of ansible-server build planning: generates synthetic inventories and playbooks of growing size,
+# times inventory parsing, plan_build and changed_hosts on each and reports cost per host. Planning is expected
+# to stay linear, exits with 1 if cost per host on the largest inventory grows more than --max-ratio times.
+#
+#   ./plan-bench.py --hosts 1000 10000 100000
+#   ./plan-bench.py --json
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from configparser import ConfigParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from ansible_server_functions import parse_inventory, plan_build, changed_hosts
+
+
+def make_inventory(hosts, services, datacenters):
+    # every host is in a service and a datacenter group, services are grouped in tiers, tiers and datacenters
+    # in environments, so closures overlap like in a real inventory
+    rnd = random.Random(0)
+    members = {}
+    for i in range(hosts):
+        members.setdefault(f'service{rnd.randrange(services)}', []).append(f'host{i}.example.com')
+        members.setdefault(f'dc{i % datacenters}', []).append(f'host{i}.example.com')
+    sections = [f'[{group}]\n' + '\n'.join(names) for group, names in members.items()]
+    tiers = services // 10 or 1
+    for tier in range(tiers):
+        sections.append(f'[tier{tier}:children]\n' + '\n'.join(f'service{i}' for i in range(services) if i % tiers == tier))
+    sections.append('[prod:children]\n' + '\n'.join(f'tier{i}' for i in range(tiers) if i % 2))
+    sections.append('[stage:children]\n' + '\n'.join(f'tier{i}' for i in range(tiers) if not i % 2))
+    sections.append('[dcs:children]\n' + '\n'.join(f'dc{i}' for i in range(datacenters)))
+    return '\n\n'.join(sections) + '\n'
+
+
+def make_playbook(services, datacenters):
+    playbook = [{'hosts': f'service{i}', 'tags': 'ansible-agent-run', 'roles': [{'role': f'role{i}'}]} for i in range(services)]
+    playbook += [{'hosts': f'dc{i}:&prod', 'tags': ['ansible-agent-run'], 'roles': [{'role': f'dc{i}'}]} for i in range(datacenters)]
+    playbook += [{'hosts': 'all:!stage', 'tags': 'ansible-agent-run', 'roles': [{'role': 'common'}]},
+                 {'hosts': '~host1[0-9]*\\.example\\.com', 'tags': 'ansible-agent-run', 'roles': [{'role': 'canary'}]},
+                 {'hosts': 'all', 'tags': 'manual', 'roles': [{'role': 'manual'}]}]
+    return playbook
+
+
+def plan(inventory_text, playbook, previous, changed):
+    inventory = ConfigParser(allow_no_value=True)
+    inventory.read_string(inventory_text)
+    host_groups, group_parents = parse_inventory(inventory)
+    all_host_groups, host_plays, host_roles, groups_roles, role_hash_hosts, host_deps = plan_build(host_groups, group_parents, playbook)
+    dirty = changed_hosts(host_deps, previous, changed)
+    return host_deps, groups_roles, dirty
+
+
+def bench(hosts, services, datacenters, repeat):
+    inventory_text = make_inventory(hosts, services, datacenters)
+    playbook = make_playbook(services, datacenters)
+    host_deps, groups_roles, dirty = plan(inventory_text, playbook, {}, None)
+    # incremental plan against previous build, with group_vars of one service changed
+    previous = {host: dict(deps, folder='previous') for host, deps in host_deps.items()}
+    changed = {'group_vars', 'group_vars/service0'}
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        host_deps, groups_roles, dirty = plan(inventory_text, playbook, previous, changed)
+        timings.append(time.time() - start)
+    wall = min(timings)
+    return {
+        'hosts': hosts,
+        'role_hashes': len(groups_roles),
+        'dirty': len(dirty),
+        'wall_sec': round(wall, 4),
+        'us_per_host': round(wall / hosts * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling check of ansible-server build planning')
+    parser.add_argument('--hosts', type=int, nargs='+', default=[1000, 10000, 100000], help='inventory sizes')
+    parser.add_argument('--services', type=int, default=100, help='number of service groups and plays')
+    parser.add_argument('--datacenters', type=int, default=10, help='number of datacenter groups')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, best one is reported')
+    parser.add_argument('--max-ratio', type=float, default=2.5, help='allowed growth of cost per host')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    results = [bench(i, args.services, args.datacenters, args.repeat) for i in sorted(args.hosts)]
+    ratio = results[-1]['us_per_host'] / results[0]['us_per_host']
+    if args.json:
+        print(json.dumps({'results': results, 'ratio': round(ratio, 2)}, indent=2))
+    else:
+        for result in results:
+            print(' '.join(f'{k}={v}' for k, v in result.items()))
+        print(f'cost per host grew {ratio:.2f}x from {results[0]["hosts"]} to {results[-1]["hosts"]} hosts')
+    sys.exit(1 if ratio > args.max_ratio else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,20 @@
 
 from configparser import ConfigParser
 import yaml
-import socket
 from jinja2 import Template
 import os
 import sys
+import errno
 import shutil
-import filecmp
+import subprocess
 import logging
 import git
 from git import RemoteProgress
 import time
 import pprint
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from ansible_server_functions import *
 
@@ -25,9 +28,19 @@ logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', level=geta
 path_tmp        = config.get('ansible-server', 'path_tmp')
 path_prod       = config.get('ansible-server', 'path_prod')
 path_doc_root   = config.get('ansible-server', 'path_doc_root')
+path_store      = config.get('ansible-server', 'path_store', fallback=f"{path_prod}/.store")
+# host folders are built in place under trees, agents see them through generation nginx serves via current symlink
+path_trees          = f"{path_doc_root}/trees"
+path_generations    = f"{path_doc_root}/generations"
 nginx_config_tmp  = config.get('nginx', 'nginx_config_tmp')
 nginx_config_prod = config.get('nginx', 'nginx_config_prod')
 TIMER_SCHEDULED_RUN_SEC = int(config.get('ansible-server', 'timer_scheduled_run_sec', fallback=10))
+BUILD_WORKERS     = int(config.get('ansible-server', 'build_workers', fallback=os.cpu_count() or 1))
+
+# rollout config
+ROLLOUT_RATE_HOSTS_PER_SEC  = float(config.get('rollout', 'rate_hosts_per_sec',  fallback=0))
+ROLLOUT_WAVES               = int(config.get('rollout', 'waves',                  fallback=0))
+ROLLOUT_WAVE_INTERVAL_SEC   = int(config.get('rollout', 'wave_interval_sec',      fallback=60))
 
 # git config
 GIT_URL         = config.get('git', 'git_url')
@@ -36,55 +49,174 @@ GIT_BRANCH      = config.get('git', 'git_branch')
 
 VAULT_PASSWORD      = config.get('ansible-server', 'vault_password',  fallback='').encode()
 NEW_VAULT_PASSWORD  = config.get('ansible-server', 'new_vault_password',  fallback='').encode()
+REENCRYPT_CACHE     = config.get('ansible-server', 'reencrypt_cache',  fallback='/opt/ansible-server/reencrypt_cache.sqlite')
+REENCRYPT_WORKERS   = int(config.get('ansible-server', 'reencrypt_workers',  fallback=os.cpu_count() or 1))
 
 do_reencrypt = len(VAULT_PASSWORD) > 0 and len(NEW_VAULT_PASSWORD) > 0
-if do_reencrypt:
-    from ansible.parsing.vault import VaultLib
-    from ansible.parsing.vault import VaultSecret
-    from ansible import constants as C
-    
-    vault       = VaultLib([(C.DEFAULT_VAULT_IDENTITY, VaultSecret(VAULT_PASSWORD))])
-    new_vault   = VaultLib([(C.DEFAULT_VAULT_IDENTITY, VaultSecret(NEW_VAULT_PASSWORD))])
-
-
-timestamp = round(time.time())
 
+resolver = resolver_from_config(config)
+collector = collector_from_config(config)
 
-reencrypted = {}
-
-def copy_with_reencrypt(src_base: 'path base shared by all files', src: 'used as dict key - path part, unique for every file', dst):
-    sha256_sum = sha256(f"{src_base}/{src}")
-    if src in reencrypted and reencrypted[src]['sha256'] == sha256_sum:
-        if reencrypted[src]['secrets_count']:
-            if os.path.exists(reencrypted[src]['cache']):
-                # valid cache found
-                logging.debug(f"using cached reencrypted {src}")
-            else:
-                # cache is missing for some reason
-                logging.debug(f"reencrypted cache missing for {src}, recreate")
-                reencrypt(f"{src_base}/{src}", reencrypted[src]['cache'], vault, new_vault)
-            shutil.copy(reencrypted[src]['cache'], dst)
-        else:
-            # no secrets in this file, just copy original
-            logging.debug(f"{src} has no secrets, copying as is")
-            shutil.copy(f"{src_base}/{src}", dst)
+reencrypt_lock = threading.Lock()
+if do_reencrypt:
+    reencrypt_db = open_reencrypt_cache(REENCRYPT_CACHE, VAULT_PASSWORD, NEW_VAULT_PASSWORD)
+    secret_memo  = SecretMemo(reencrypt_db, reencrypt_lock)
+
+# what host folders of the last built commit are made of: {'sha': commit, 'hosts': {host: inputs and folder}},
+# kept in memory, so the first build after a restart is a full one
+build_index = {}
+
+# nginx access list, included into the map of nginx/ansible-server.conf.j2, one "hostname client_ip" pair per line
+acl_template = Template('''# generated by ansible-server
+{% for host, hostip in pairs -%}
+"{{ host }} {{ hostip }}" 1;
+{% endfor -%}
+''')
+
+def link_stored(stored, dst, save):
+    # dst becomes a hardlink to stored object, save(path) writes object content when it is not stored yet. collector
+    # sweeps objects no tree links to in background, so an object removed between the check and the link is stored again
+    while True:
+        try:
+            if not os.path.exists(stored):
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                save(f"{stored}.{threading.get_ident()}.tmp")
+                os.rename(f"{stored}.{threading.get_ident()}.tmp", stored)
+            try:
+                os.link(stored, dst)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # host folders are built on path_doc_root filesystem, they get copies when store is on another one
+                shutil.copy(stored, dst)
+            return
+        except FileNotFoundError:
+            if os.path.exists(stored):
+                raise
+            logging.debug(f"{stored} was collected while being linked, storing it again")
+
+
+def store_file(src, dst, key=None):
+    # content addressable store - dst becomes a hardlink to the single stored copy of src content, so unchanged
+    # files take no space and no writes no matter how many commits refer to them. key is git blob id or content
+    # sha256, executable files are stored separately, since hardlinks share permissions
+    if key is None:
+        key = sha256(src)
+    if os.stat(src).st_mode & 0o100:
+        key += 'x'
+    link_stored(f"{path_store}/{key[:2]}/{key}", dst, lambda path: shutil.copy(src, path))
+
+
+def store_data(data, dst):
+    # same as store_file, for content that is not in a file, like reencrypted vars
+    def save(path):
+        with open(path, 'wb') as file:
+            file.write(data)
+    key = hashlib.sha256(data).hexdigest()
+    link_stored(f"{path_store}/{key[:2]}/{key}", dst, save)
+
+
+def git_blob_ids(commit_sha):
+    # {path: blob id} of regular files in commit, blob id identifies content without reading files
+    blob_ids = {}
+    for line in repo.git.ls_tree('-r', '-z', '--full-tree', commit_sha).split('\0'):
+        if line:
+            mode, kind, blob_id = line.split('\t', 1)[0].split()
+            if mode in ('100644', '100755'):
+                blob_ids[line.split('\t', 1)[1]] = blob_id
+    return blob_ids
+
+
+def copy_with_reencrypt(src_base: 'path base shared by all files', src: 'path part, used in messages', dst, blob_id=None):
+    # cache is keyed by git blob id of source, so sources are not even read when they have not changed
+    key = blob_id or sha256(f"{src_base}/{src}")
+    now = round(time.time())
+    with reencrypt_lock, reencrypt_db:
+        row = reencrypt_db.execute('SELECT secrets_count, output FROM reencrypted WHERE key = ?', (key,)).fetchone()
+        if row:
+            # remember when we last refered this secret for housekeeping
+            reencrypt_db.execute('UPDATE reencrypted SET last_access = ? WHERE key = ?', (now, key))
+    if row:
+        logging.debug(f"using cached reencrypted {src}")
     else:
-        # no cache or cache is stale
+        # no cache or cache is stale, reencrypting outside of lock, since that is the slow part
         logging.debug(f"creating reencrypted cache for {src}")
-        secrets_count = reencrypt(f"{src_base}/{src}", f"{path_tmp}/reencrypted/{src}", vault, new_vault)
-        reencrypted[src] = {'sha256': sha256_sum, 'secrets_count': secrets_count, 'cache': f"{path_tmp}/reencrypted/{src}"}
-        if secrets_count:
-            logging.debug(f"created reencrypted cache for {src}")
-            shutil.copy(reencrypted[src]['cache'], dst)
-        else:
-            logging.debug(f"{src} has no secrets, copying as is")
-            if os.path.exists(reencrypted[src]['cache']):
-                # delete stale cache
-                logging.debug(f"delete stale cache for {src}")
-                os.remove(reencrypted[src]['cache'])
-            shutil.copy(f"{src_base}/{src}", dst)
-    # remember when we last refered this secret for housekeeping
-    reencrypted[src]['last_access'] = timestamp
+        with open(f"{src_base}/{src}", 'rb') as file:
+            output, secrets_count = reencrypt_files({src: file.read()}, VAULT_PASSWORD, NEW_VAULT_PASSWORD, 1, secret_memo)[src]
+        row = (secrets_count, output if secrets_count else None)
+        with reencrypt_lock, reencrypt_db:
+            reencrypt_db.execute('INSERT OR REPLACE INTO reencrypted VALUES (?, ?, ?, ?)', (key, row[0], row[1], now))
+    if row[0]:
+        store_data(row[1], dst)
+    else:
+        # no secrets in this file, just copy original
+        logging.debug(f"{src} has no secrets, copying as is")
+        store_file(f"{src_base}/{src}", dst, key)
+
+
+def reencrypt_stage(sources, blob_ids):
+    # reencrypt every source missing in cache in one parallel stage, so that builds after it only read the cache
+    now = round(time.time())
+    keys = {src: blob_ids.get(src) or sha256(f"{GIT_LOCAL_PATH}/{src}") for src in sources}
+    files = {}
+    with reencrypt_lock:
+        for src, key in keys.items():
+            if key not in files and reencrypt_db.execute('SELECT 1 FROM reencrypted WHERE key = ?', (key,)).fetchone() is None:
+                with open(f"{GIT_LOCAL_PATH}/{src}", 'rb') as file:
+                    files[key] = file.read()
+    if not files:
+        return
+    logging.info(f"Reencrypting {len(files)} of {len(keys)} vars files")
+    result = reencrypt_files(files, VAULT_PASSWORD, NEW_VAULT_PASSWORD, REENCRYPT_WORKERS, secret_memo)
+    with reencrypt_lock, reencrypt_db:
+        reencrypt_db.executemany('INSERT OR REPLACE INTO reencrypted VALUES (?, ?, ?, ?)',
+                                 [(key, count, output if count else None, now) for key, (output, count) in result.items()])
+
+
+def changed_files(commit_sha):
+    # paths changed since the commit of build_index and all their parent folders, None if it is unknown
+    if not build_index:
+        return None
+    try:
+        diff = repo.git.diff('--name-only', '--no-renames', build_index['sha'], commit_sha)
+    except Exception as e:
+        logging.warning(f"Failed to diff {build_index['sha']}..{commit_sha}, rebuilding all hosts: {e}")
+        return None
+    changed = set()
+    for path in diff.splitlines():
+        parts = path.split('/')
+        changed.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    return changed
+
+
+def update_nginx_acl(hosts, host_ips):
+    # access list is rendered in one go and compared with the one nginx serves, nginx is reloaded only if it
+    # changed, since every reload starts a new set of workers
+    started = time.time()
+    for host in hosts:
+        if not host_ips[host]:
+            logging.error(f'Failed to get host IPs: {host}')
+    # addresses are sorted, so resolver answering in different order doesn't look like a change, and pairs are
+    # unique, as nginx compares map keys case insensitively and refuses duplicates
+    pairs = list(dict.fromkeys((host.lower(), hostip) for host in hosts for hostip in sorted(host_ips[host] or [])))
+    acl = acl_template.render(pairs=pairs)
+    generated = time.time()
+    logging.info(f'Generated nginx access list of {len(hosts)} hosts, {len(pairs)} addresses in {generated - started:.2f}s')
+
+    if os.path.exists(nginx_config_prod):
+        with open(nginx_config_prod, 'r') as file:
+            if file.read() == acl:
+                logging.info('nginx config has not changed')
+                return
+    logging.info('update ngnix config')
+    with open(nginx_config_tmp, 'w') as file:
+        file.write(acl)
+    os.replace(nginx_config_tmp, nginx_config_prod)
+    result = subprocess.run(['systemctl', 'reload', 'nginx.service'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if result.returncode != 0:
+        logging.error(f'nginx reload failed: {result.stdout.strip()}')
+    else:
+        logging.info(f'Reloaded nginx in {time.time() - generated:.2f}s')
 
 
 def run_server(commit_sha):
@@ -97,49 +229,90 @@ def run_server(commit_sha):
         playbook = yaml.safe_load(file)
 
 
+    planning_started = time.time()
     host_groups, group_parents = parse_inventory(inventory)
+    all_host_groups, host_plays, host_roles, groups_roles, role_hash_hosts, host_deps = plan_build(host_groups, group_parents, playbook, group_members=parse_group_members(inventory))
+    logging.info(f'Planned {len(host_roles)} hosts in {len(groups_roles)} role_hashes in {time.time() - planning_started:.2f}s')
+
+    # rollout plan agents use to pick their start slot, instead of all of them running at once
+    if ROLLOUT_WAVES:
+        rollout = {'waves': ROLLOUT_WAVES, 'wave_interval_sec': ROLLOUT_WAVE_INTERVAL_SEC}
+    elif ROLLOUT_RATE_HOSTS_PER_SEC:
+        rollout = {'window_sec': round(len(host_groups) / ROLLOUT_RATE_HOSTS_PER_SEC)}
+    else:
+        rollout = {}
 
-
-    host_roles = {}
-    groups_roles = {}
-    all_host_groups = {}
-
-    for host, groups in host_groups.items():
-        # build host roles dicts
-        full_group_list = sorted(set(add_parent_groups(groups, group_parents)))
-        all_host_groups[host] = full_group_list
-        role_hash = hash(' '.join(full_group_list))
-        if role_hash not in groups_roles:
-            groups_roles[role_hash] = []
-            for play in playbook:
-                if (type(play['tags']) is list and 'ansible-agent-run' in play['tags'] or
-                    type(play['tags']) is str  and 'ansible-agent-run' == play['tags']):
-                    if (type(play['hosts']) is list and set(play['hosts']) & set(['all'] + full_group_list) or
-                        type(play['hosts']) is str  and play['hosts'] in ['all'] + full_group_list):
-                            groups_roles[role_hash].append(play)
-        host_roles[host] = role_hash
-
-
-    location_template = '''location /{{ hostname }} {
-    autoindex on;
-    autoindex_format json;
-    alias /var/www/ansible-server/{{ hostname }};
-    {% for hostip in hostips -%}
-    allow {{ hostip }};
-    {% endfor -%}
-    deny all;
-    }
-
-    '''
-
-    nginx_config_tmp_fd = open(nginx_config_tmp, 'w')
-
+    collector.pin(f"{timestamp}_{commit_sha}")
     os.makedirs(f"{path_prod}/{timestamp}_{commit_sha}/roles")
     os.makedirs(f"{path_prod}/{timestamp}_{commit_sha}/group_vars")
-    copied_roles = []
-    copied_group_vars = []
-
-    for role_hash, host_group_roles in groups_roles.items():
+    copied_roles = set()
+    copied_group_vars = set()
+    # group_vars of this commit, looked up in a set instead of a stat per host and group
+    group_vars = set(os.listdir(f"{GIT_LOCAL_PATH}/group_vars")) if os.path.isdir(f"{GIT_LOCAL_PATH}/group_vars") else set()
+    manifest_cache = {}
+    blob_ids = git_blob_ids(commit_sha)
+
+    def copy_group_vars(host_group):
+        if host_group not in copied_group_vars:
+            if do_reencrypt:
+                copy_with_reencrypt(GIT_LOCAL_PATH, f"group_vars/{host_group}", f"{path_prod}/{timestamp}_{commit_sha}/group_vars/{host_group}", blob_ids.get(f"group_vars/{host_group}"))
+            else:
+                store_file(f"{GIT_LOCAL_PATH}/group_vars/{host_group}", f"{path_prod}/{timestamp}_{commit_sha}/group_vars/{host_group}", blob_ids.get(f"group_vars/{host_group}"))
+            copied_group_vars.add(host_group)
+
+    def copy_role(role):
+        if role not in copied_roles:
+            logging.debug(f"create {path_prod}/{timestamp}_{commit_sha}/roles/{role}")
+            # role tree is made of hardlinks to store, vars and defaults are reencrypted on the way
+            for root, dirs, files in os.walk(f"{GIT_LOCAL_PATH}/roles/{role}", followlinks=True):
+                folder = os.path.relpath(root, GIT_LOCAL_PATH)
+                os.makedirs(f"{path_prod}/{timestamp}_{commit_sha}/{folder}")
+                for name in files:
+                    if do_reencrypt and folder in (f"roles/{role}/vars", f"roles/{role}/defaults"):
+                        copy_with_reencrypt(GIT_LOCAL_PATH, f"{folder}/{name}", f"{path_prod}/{timestamp}_{commit_sha}/{folder}/{name}", blob_ids.get(f"{folder}/{name}"))
+                    else:
+                        store_file(f"{root}/{name}", f"{path_prod}/{timestamp}_{commit_sha}/{folder}/{name}", blob_ids.get(f"{folder}/{name}"))
+            copied_roles.add(role)
+
+    build_started = time.time()
+
+    # dependency index - host folder is rebuilt only if its inputs changed, otherwise folder built for a previous
+    # commit is carried forward by generation link, so build time and disk churn follow the size of the change
+    changed = changed_files(commit_sha)
+    previous = build_index.get('hosts', {})
+    dirty = changed_hosts(host_deps, previous, changed)
+    dirty.update(host for host in host_deps.keys() - dirty if not os.path.isdir(f"{path_trees}/{host}/{previous[host]['folder']}"))
+    logging.info(f"{len(dirty)} of {len(host_roles)} hosts changed since {build_index.get('sha')}")
+
+    # vars files of hosts to rebuild are reencrypted upfront by a process pool
+    if do_reencrypt:
+        sources = set()
+        dirty_groups = set()
+        dirty_roles = set()
+        for host in dirty:
+            dirty_groups.update(all_host_groups[host])
+            dirty_roles.update(ii['role']  for i in host_plays[host]  for ii in i['roles'])
+            if os.path.isfile(f"{GIT_LOCAL_PATH}/host_vars/{host}"):
+                sources.add(f"host_vars/{host}")
+        sources.update(f"group_vars/{i}" for i in {'all'} | dirty_groups if i in group_vars and os.path.isfile(f"{GIT_LOCAL_PATH}/group_vars/{i}"))
+        for role in dirty_roles:
+            for folder in (f"roles/{role}/vars", f"roles/{role}/defaults"):
+                if os.path.isdir(f"{GIT_LOCAL_PATH}/{folder}"):
+                    sources.update(f"{folder}/{i}" for i in os.listdir(f"{GIT_LOCAL_PATH}/{folder}") if os.path.isfile(f"{GIT_LOCAL_PATH}/{folder}/{i}"))
+        reencrypt_stage(sources, blob_ids)
+
+    # phase 1 - artifacts shared by hosts (roles, group_vars, site.yaml and bundle of every role_hash) are built once,
+    # so that host builds below only read them and can run in parallel
+    for host in dirty:
+        for host_group in ['all'] + all_host_groups[host]:
+            if host_group in group_vars:
+                copy_group_vars(host_group)
+        for role in set(ii['role']  for i in host_plays[host]  for ii in i['roles']):
+            copy_role(role)
+
+    shared_roles = {}
+    for role_hash in set(host_roles[i] for i in dirty):
+        host_group_roles = groups_roles[role_hash]
 
         path_role_hash = f"{path_prod}/{timestamp}_{commit_sha}/role_hash/{role_hash}"
         logging.debug(f"create {path_role_hash}")
@@ -149,144 +322,159 @@ def run_server(commit_sha):
         with open(f"{path_role_hash}/site.yaml", 'w') as file:
             yaml.dump(host_group_roles, file, sort_keys=False)
 
-        for host in [k for k,v in host_roles.items() if v == role_hash]:
-
-            path_host = f"{path_tmp}/{host}/{timestamp}_{commit_sha}"
-            logging.debug (f"create {path_host}")
-            os.makedirs(f"{path_host}")
-
-            # append to nginx config
-            logging.info(host)
-            try:
-                ips = sorted(set(i[4][0] for i in socket.getaddrinfo(host, None)))
-            except:
-                logging.error(f'Failed to get host IPs: {host}')
+        # shared bundle - single archive with everything hosts of this role_hash have in common
+        shared_group_vars = [i for i in ['all'] + all_host_groups[role_hash_hosts[role_hash][0]] if i in group_vars]
+        shared_roles[role_hash] = sorted(set(ii['role']  for i in host_group_roles  for ii in i['roles']))
+        logging.debug(f"create {path_role_hash}/bundle.tar.gz")
+        make_bundle(f"{path_role_hash}/bundle.tar.gz",
+                    [(f"{path_role_hash}/site.yaml", 'site.yaml')] +
+                    [(f"{path_prod}/{timestamp}_{commit_sha}/group_vars/{i}", f"group_vars/{i}") for i in shared_group_vars] +
+                    [(f"{path_prod}/{timestamp}_{commit_sha}/roles/{i}", f"roles/{i}") for i in shared_roles[role_hash]])
+    shared_built = time.time()
+
+    def build_host(host):
+        # phase 2 - everything specific to one host, returns generation links of host and error if build failed,
+        # a failed host keeps serving its previous commit
+        role_hash = host_roles[host]
+        path_role_hash = f"{path_prod}/{timestamp}_{commit_sha}/role_hash/{role_hash}"
+        path_host = f"{path_trees}/{host}/{timestamp}_{commit_sha}"
+
+        logging.info(host)
+        error = None
+        try:
+            if host not in dirty:
+                # inputs didn't change, generation links to folder built for a previous commit
+                folder = previous[host]['folder']
             else:
-                template = Template(location_template)
-                rendered = template.render(hostname=host, hostips=ips)
-                logging.debug(rendered)
-                nginx_config_tmp_fd.write(rendered)
-
-            all_host_roles  = []
-            for play in playbook:
-                if (type(play['tags']) is list and 'ansible-agent-run' in play['tags'] or
-                    type(play['tags']) is str  and 'ansible-agent-run' == play['tags']):
-                    if (type(play['hosts']) is list and set(play['hosts']) & set([host, 'all'] + all_host_groups[host]) or
-                        type(play['hosts']) is str  and play['hosts'] in [host, 'all'] + all_host_groups[host]):
-                            all_host_roles.append(play)
-            logging.debug(pprint.pformat({'host': host, 'roles': all_host_roles}))
-
-            # write inventory for host
-            hosts_content = ''.join([f'[{i}]\n{host}\n\n' for i in all_host_groups[host]])
-            logging.debug (f"create {path_host}/hosts = \n{hosts_content}")
-            with open(f"{path_host}/hosts", 'w') as file:
-                file.write(hosts_content)
-
-            # copy host_vars
-            if os.path.exists(f"{GIT_LOCAL_PATH}/host_vars/{host}"):
-                logging.debug (f"create {path_host}/host_vars/{host}")
-                os.makedirs(f"{path_host}/host_vars")
-                if do_reencrypt:
-                    copy_with_reencrypt(GIT_LOCAL_PATH, f"host_vars/{host}", f"{path_host}/host_vars/{host}")
+                folder = f"{timestamp}_{commit_sha}"
+                logging.debug (f"create {path_host}")
+                os.makedirs(f"{path_host}")
+                all_host_roles = host_plays[host]
+                logging.debug(pprint.pformat({'host': host, 'roles': all_host_roles}))
+
+                # write inventory for host
+                hosts_content = ''.join([f'[{i}]\n{host}\n\n' for i in all_host_groups[host]])
+                logging.debug (f"create {path_host}/hosts = \n{hosts_content}")
+                with open(f"{path_host}/hosts", 'w') as file:
+                    file.write(hosts_content)
+                host_bundle = [(f"{path_host}/hosts", 'hosts')]
+
+                # copy host_vars
+                if os.path.exists(f"{GIT_LOCAL_PATH}/host_vars/{host}"):
+                    logging.debug (f"create {path_host}/host_vars/{host}")
+                    os.makedirs(f"{path_host}/host_vars")
+                    if do_reencrypt:
+                        copy_with_reencrypt(GIT_LOCAL_PATH, f"host_vars/{host}", f"{path_host}/host_vars/{host}", blob_ids.get(f"host_vars/{host}"))
+                    else:
+                        store_file(f"{GIT_LOCAL_PATH}/host_vars/{host}", f"{path_host}/host_vars/{host}", blob_ids.get(f"host_vars/{host}"))
+                    host_bundle.append((f"{path_host}/host_vars", 'host_vars'))
+
+                # symlink group_vars
+                logging.debug (f"create {path_host}/group_vars/{['all'] + all_host_groups[host]}")
+                os.makedirs(f"{path_host}/group_vars")
+                for host_group in ['all'] + all_host_groups[host]:
+                    if host_group in group_vars:
+                        os.symlink(f"{path_prod}/{timestamp}_{commit_sha}/group_vars/{host_group}", f"{path_host}/group_vars/{host_group}")
+
+
+                if len(all_host_roles) > len(groups_roles[role_hash]):
+                    # need dedicated site.yaml for this host
+                    logging.debug (f"create {path_host}/site.yaml = \n{all_host_roles}")
+                    with open(f"{path_host}/site.yaml", 'w') as file:
+                        yaml.dump(all_host_roles, file, sort_keys=False)
+                    host_bundle.append((f"{path_host}/site.yaml", 'site.yaml'))
                 else:
-                    shutil.copy(f"{GIT_LOCAL_PATH}/host_vars/{host}", f"{path_host}/host_vars/{host}")
-
-            # copy and symlink group_vars
-            logging.debug (f"create {path_role_hash}/group_vars/{['all'] + all_host_groups[host]}")
-            os.makedirs(f"{path_host}/group_vars")
-            for host_group in ['all'] + all_host_groups[host]:
-                if os.path.exists(f"{GIT_LOCAL_PATH}/group_vars/{host_group}"):
-                    if host_group not in copied_group_vars:
-                        if do_reencrypt:
-                            copy_with_reencrypt(GIT_LOCAL_PATH, f"group_vars/{host_group}", f"{path_prod}/{timestamp}_{commit_sha}/group_vars/{host_group}")
-                        else:
-                            shutil.copy(f"{GIT_LOCAL_PATH}/group_vars/{host_group}", f"{path_prod}/{timestamp}_{commit_sha}/group_vars/{host_group}")
-                        copied_group_vars.append(host_group)
-                    os.symlink(f"{path_prod}/{timestamp}_{commit_sha}/group_vars/{host_group}", f"{path_host}/group_vars/{host_group}")
-
-
-            if len(all_host_roles) > len(host_group_roles):
-                # need dedicated site.yaml for this host
-                logging.debug (f"create {path_host}/site.yaml = \n{all_host_roles}")
-                with open(f"{path_host}/site.yaml", 'w') as file:
-                    yaml.dump(all_host_roles, file, sort_keys=False)
-            else:
-                # can use shared site.yaml for this host
-                logging.debug (f"symlink {path_host}/site.yaml -> {path_role_hash}/site.yaml")
-                os.symlink(f"{path_role_hash}/site.yaml", f"{path_host}/site.yaml")
-
-            # copy and symlink roles
-            logging.debug (f"create {path_host}/roles")
-            os.makedirs(f"{path_host}/roles")
-            for role in set(ii['role']  for i in all_host_roles  for ii in i['roles']):
-                if role not in copied_roles:
-                    logging.debug(f"create {path_prod}/{timestamp}_{commit_sha}/roles/{role}")
-                    shutil.copytree(f"{GIT_LOCAL_PATH}/roles/{role}", f"{path_prod}/{timestamp}_{commit_sha}/roles/{role}")
-                    if do_reencrypt and os.path.exists(f"{GIT_LOCAL_PATH}/roles/{role}/vars"):
-                        for vars in os.listdir(f"{GIT_LOCAL_PATH}/roles/{role}/vars"):
-                            copy_with_reencrypt(GIT_LOCAL_PATH, f"roles/{role}/vars/{vars}", f"{path_prod}/{timestamp}_{commit_sha}/roles/{role}/vars/{vars}")
-                    if do_reencrypt and os.path.exists(f"{GIT_LOCAL_PATH}/roles/{role}/defaults"):
-                        for vars in os.listdir(f"{GIT_LOCAL_PATH}/roles/{role}/defaults"):
-                            copy_with_reencrypt(GIT_LOCAL_PATH, f"roles/{role}/defaults/{vars}", f"{path_prod}/{timestamp}_{commit_sha}/roles/{role}/defaults/{vars}")
-                    copied_roles.append(role)
-                logging.debug(f"symlink {path_host}/roles/{role} -> {path_prod}/{timestamp}_{commit_sha}/roles/{role}")
-                os.symlink(f"{path_prod}/{timestamp}_{commit_sha}/roles/{role}", f"{path_host}/roles/{role}")
-
-            # move prepared folder structure to document root
-            logging.debug (f"mv  {path_host}   {path_doc_root}/{host}/{timestamp}_{commit_sha}")
-            shutil.move(f"{path_host}", f"{path_doc_root}/{host}/{timestamp}_{commit_sha}")
-
-
-    nginx_config_tmp_fd.close()
-
-
-    if os.path.exists(nginx_config_prod) and filecmp.cmp(nginx_config_prod, nginx_config_tmp):
-        logging.info('nginx config has not changed')
-    else:
-        logging.info('update ngnix config')
-        shutil.move(nginx_config_tmp, nginx_config_prod)
-        os.popen("systemctl reload nginx.service")
-    
-    
-    # Housekeeping
-    logging.debug(f"Cleanup stale folders, preserving 3 last commits and folders younger than 2 hours")
-    for folder in sorted(os.listdir(path_prod))[:-3]:
-        folder_ts = folder.split('_')[0]
-        if int(folder_ts) < timestamp - 7200:
-            logging.info(f"Removing {folder} stale folders from {path_prod} and {path_doc_root}/*/")
-            for host_folder in os.listdir(path_doc_root):
-                if os.path.exists(f"{path_doc_root}/{host_folder}/{folder}"):
-                    shutil.rmtree(f"{path_doc_root}/{host_folder}/{folder}")
-            shutil.rmtree(f"{path_prod}/{folder}")
-
-    folders_to_keep = os.listdir(path_prod)
-    for host_folder in os.listdir(path_doc_root):
-        folders = os.listdir(f"{path_doc_root}/{host_folder}")
-        if len(folders) == 0:
-            logging.info(f"Removing empty folder {path_doc_root}/{host_folder}")
-            shutil.rmtree(f"{path_doc_root}/{host_folder}")
-        elif host_folder not in host_groups.keys():
-            logging.info(f"Removing folder for host not in inventory {path_doc_root}/{host_folder}")
-            shutil.rmtree(f"{path_doc_root}/{host_folder}")
+                    # can use shared site.yaml for this host
+                    logging.debug (f"symlink {path_host}/site.yaml -> {path_role_hash}/site.yaml")
+                    os.symlink(f"{path_role_hash}/site.yaml", f"{path_host}/site.yaml")
+
+                # symlink roles
+                logging.debug (f"create {path_host}/roles")
+                os.makedirs(f"{path_host}/roles")
+                for role in set(ii['role']  for i in all_host_roles  for ii in i['roles']):
+                    logging.debug(f"symlink {path_host}/roles/{role} -> {path_prod}/{timestamp}_{commit_sha}/roles/{role}")
+                    os.symlink(f"{path_prod}/{timestamp}_{commit_sha}/roles/{role}", f"{path_host}/roles/{role}")
+                    if role not in shared_roles[role_hash]:
+                        host_bundle.append((f"{path_host}/roles/{role}", f"roles/{role}"))
+
+                # manifest lets agents download only files changed since their previous commit
+                logging.debug (f"create {path_host}/.manifest.json")
+                write_json(f"{path_host}/.manifest.json", build_manifest(path_host, manifest_cache))
+
+                # bundles are dot-files, so that nginx autoindex hides them from agents crawling the folder
+                logging.debug (f"create {path_host}/.host.tar.gz, symlink {path_host}/.bundle.tar.gz -> {path_role_hash}/bundle.tar.gz")
+                make_bundle(f"{path_host}/.host.tar.gz", host_bundle)
+                os.symlink(f"{path_role_hash}/bundle.tar.gz", f"{path_host}/.bundle.tar.gz")
+
+            links = dict(kept.get(host, {}), **{f"{timestamp}_{commit_sha}": folder})
+        except Exception as e:
+            shutil.rmtree(path_host, True)
+            links = kept.get(host, {})
+            error = e
+
+        # generation folder of host - relative links to folders of every commit agents may still be downloading,
+        # ansiblectl builds and pointer to the latest commit
+        path_generation_host = f"{path_generations}/{timestamp}_{commit_sha}/{host}"
+        os.makedirs(path_generation_host)
+        for name, folder in links.items():
+            os.symlink(f"../../../trees/{host}/{folder}", f"{path_generation_host}/{name}")
+        os.symlink(f"../../../ansiblectl/{host}", f"{path_generation_host}/ansiblectl")
+        if error is None:
+            # small pointer to the latest commit, agents poll it with If-None-Match instead of listing the host folder
+            write_json(f"{path_generation_host}/.latest", {'commit': f"{timestamp}_{commit_sha}", 'published': timestamp, 'rollout': rollout})
+        elif os.path.exists(f"{path_doc_root}/current/{host}/.latest"):
+            # hardlink keeps ETag, so agents don't notice anything
+            os.link(f"{path_doc_root}/current/{host}/.latest", f"{path_generation_host}/.latest")
+        return links, error
+
+    # all hosts are resolved in one concurrent batch, so a slow resolver costs one timeout, not one per host
+    host_ips = resolver.resolve_all(list(host_roles))
+    resolved = time.time()
+    logging.info(f'Resolved {len(host_ips)} hosts in {resolved - shared_built:.1f}s')
+
+    # hosts are built by a pool, but results are collected in inventory order, so logs don't depend on which
+    # worker finished first
+    kept = collector.kept()
+    with ThreadPoolExecutor(max_workers=BUILD_WORKERS) as pool:
+        futures = {host: pool.submit(build_host, host) for host in host_roles}
+    failed = 0
+    hosts_index = {}
+    generation_links = {}
+    for host, future in futures.items():
+        generation_links[host], error = future.result()
+        if error is not None:
+            # left out of index, so it is rebuilt on next commit
+            failed += 1
+            logging.error(f'Failed to build {host}: {error}')
         else:
-            for folder in folders:
-                if folder == 'ansiblectl':
-                    # housekeep ansiblectl folders
-                    for ansiblectl_folder in os.listdir(f"{path_doc_root}/{host_folder}/ansiblectl"):
-                        folder_ts = ansiblectl_folder.split('_')[0]
-                        if int(folder_ts) < timestamp - 7500:
-                            logging.info(f"Removing stale ansiblectl folder {path_doc_root}/{host_folder}/ansiblectl/{ansiblectl_folder}")
-                            shutil.rmtree(f"{path_doc_root}/{host_folder}/ansiblectl/{ansiblectl_folder}")
-                elif folder not in folders_to_keep:
-                    logging.info(f"Removing stale folder {path_doc_root}/{host_folder}/{folder}")
-                    shutil.rmtree(f"{path_doc_root}/{host_folder}/{folder}")
-    
+            hosts_index[host] = dict(host_deps[host], folder=previous[host]['folder'] if host not in dirty else f"{timestamp}_{commit_sha}")
+    build_index.clear()
+    build_index.update(sha=commit_sha, hosts=hosts_index)
+    logging.info(f'Built {commit_sha}: shared artifacts in {shared_built - build_started:.1f}s, '
+                 f'{len(futures) - failed} hosts ({len(dirty)} rebuilt) in {time.time() - resolved:.1f}s with {BUILD_WORKERS} workers, {failed} failed')
+
+
+    # generation is published at once by switching current symlink, so agents see either previous or this commit
+    # of every host, and publishing costs the same however many hosts there are
+    if os.path.lexists(f"{path_doc_root}/current.tmp"):
+        os.remove(f"{path_doc_root}/current.tmp")
+    os.symlink(f"generations/{timestamp}_{commit_sha}", f"{path_doc_root}/current.tmp")
+    os.replace(f"{path_doc_root}/current.tmp", f"{path_doc_root}/current")
+    logging.info(f'Published generation {timestamp}_{commit_sha}')
+
+    update_nginx_acl(host_roles, host_ips)
+
+
+    # trees of older commits are removed by collector in background, once nothing refers to them
+    collector.publish(f"{timestamp}_{commit_sha}", generation_links, hosts_index, host_groups)
+
     # remove stale reencrypted secrets
-    for src in [k for k,v in reencrypted.items() if v['last_access'] < timestamp - 86400]:
-        logging.info(f"reencrypted {src} not refered for 24 hours, removing")
-        if os.path.exists(reencrypted[src]['cache']):
-            os.remove(reencrypted[src]['cache'])
-        del reencrypted[src]
+    if do_reencrypt:
+        with reencrypt_lock, reencrypt_db:
+            removed = reencrypt_db.execute('DELETE FROM reencrypted WHERE last_access < ?', (timestamp - 86400,)).rowcount
+            removed += reencrypt_db.execute('DELETE FROM secrets WHERE last_access < ?', (timestamp - 86400,)).rowcount
+        if removed:
+            logging.info(f"Removed {removed} reencrypted files and secrets not refered for 24 hours from {REENCRYPT_CACHE}")
 
 
 
@@ -297,8 +485,10 @@ os.makedirs(path_tmp)
 
 if not os.path.exists(path_prod):
     os.makedirs(path_prod)
-if not os.path.exists(path_doc_root):
-    os.makedirs(path_doc_root)
+for path in (path_doc_root, path_trees, path_generations, f"{path_doc_root}/ansiblectl"):
+    if not os.path.exists(path):
+        os.makedirs(path)
+collector.start()
 
 
 class CloneProgress(RemoteProgress):
@@ -1,10 +1,20 @@
 #!/usr/bin/python3
 
 import re
+import fnmatch
 import os
-import sys
+import shutil
 import logging
 import hashlib
+import tarfile
+import io
+import json
+import sqlite3
+import multiprocessing
+import socket
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 def sha256(file):
@@ -16,50 +26,399 @@ def sha256(file):
     return sha256_hash.hexdigest()
 
 
-def reencrypt(src, dst, vault, new_vault):
-    # not memory efficient, but fast - ok since we are not expecting yamls to be large
-    with open(src, 'rb') as file:
-        lines = file.readlines()
-    output = b""
-    secret = b""
-    secrets_count = 0
-    # add an empty element, so that if secret is in very end of the file, loop will still detect it
-    for line in lines + [b""]:
-        if re.match(b"^\s*\$ANSIBLE_VAULT;1.[12];AES256\s*$", line):
-            # start of secret
-            secret = line.strip()
-        elif secret and re.match(b"^\s*[\da-f]+\s*$", line):
+def build_manifest(path, cache):
+    # {relative path: {sha256, size}} for every file in a host folder, following symlinks to shared artifacts,
+    # cache is keyed by real path, so files shared by many hosts are hashed once per build
+    manifest = {}
+    for root, dirs, files in os.walk(path, followlinks=True):
+        if root == path:
+            # skip our own metadata (bundles, manifest)
+            files = [i for i in files if not i.startswith('.')]
+        for name in files:
+            real = os.path.realpath(os.path.join(root, name))
+            if real not in cache:
+                cache[real] = {'sha256': sha256(real), 'size': os.path.getsize(real)}
+            manifest[os.path.relpath(os.path.join(root, name), path)] = cache[real]
+    return manifest
+
+
+def make_bundle(dst, members):
+    # pack (source path, name in archive) pairs into a tar.gz, following symlinks so archive holds real content
+    with tarfile.open(f"{dst}.tmp", 'w:gz', compresslevel=6, dereference=True) as tar:
+        for src, arcname in members:
+            tar.add(src, arcname=arcname)
+    os.rename(f"{dst}.tmp", dst)
+
+
+def write_json(dst, data):
+    # write via rename, so nginx never serves a half written file
+    with open(f"{dst}.tmp", 'w') as file:
+        json.dump(data, file, sort_keys=True)
+    os.rename(f"{dst}.tmp", dst)
+
+
+# vault block: header line, which indentation is kept for the whole block, followed by hex lines
+VAULT_HEADER    = re.compile(b"^(\\s*)\\$ANSIBLE_VAULT;1.[12];AES256\\s*$")
+VAULT_BODY      = re.compile(b"^\\s*[\\da-f]+\\s*$")
+
+
+def iter_secrets(lines):
+    # single pass over lines of a file, yields plain chunks as bytes and vault blocks as (indent, ciphertext)
+    plain = []
+    secret = None
+    for line in lines:
+        header = VAULT_HEADER.match(line)
+        if secret is not None and not header and VAULT_BODY.match(line):
             # reading secret
-            secret += b"\n" + line.strip()
-        elif secret:
+            secret[1].append(line.strip())
+            continue
+        if secret is not None:
             # end of secret
-            try:
-                new_secret = new_vault.encrypt(vault.decrypt(secret))
-                output += re.sub(b'(.+\n)', b'          \\1', new_secret)
-            except Exception as e:
-                logging.error(f'Failed to reencrypt secret in {src}, copying secret as is: {e}, line {sys.exc_info()[-1].tb_lineno}')
-                output += secret
-            else:
-                secrets_count += 1
-            secret = ''
-            output += line
+            yield secret[0], b"\n".join(secret[1])
+            secret = None
+        if header:
+            # start of secret
+            if plain:
+                yield b"".join(plain)
+                plain = []
+            secret = (header.group(1), [line.strip()])
         else:
             # other lines
-            output += line
+            plain.append(line)
+    if secret is not None:
+        yield secret[0], b"\n".join(secret[1])
+    if plain:
+        yield b"".join(plain)
+
+
+def format_secret(indent, ciphertext):
+    return b"".join(indent + line + b"\n" for line in ciphertext.splitlines())
+
+
+def reencrypt_secret(secret, vault, new_vault):
+    # two pbkdf2 key derivations, this is where reencryption time goes
+    return new_vault.encrypt(vault.decrypt(secret))
+
+
+def write_secrets(parts, new_secrets, out, src=''):
+    # write plain parts and reencrypted secrets (or exceptions) to out, secret is copied as is if it failed,
+    # returns number of reencrypted secrets, src is only used in messages
+    new_secrets = iter(new_secrets)
+    secrets_count = 0
+    for part in parts:
+        if isinstance(part, bytes):
+            out.write(part)
+            continue
+        new_secret = next(new_secrets)
+        if isinstance(new_secret, Exception):
+            logging.error(f'Failed to reencrypt secret in {src}, copying secret as is: {new_secret}')
+            out.write(format_secret(*part))
+        else:
+            out.write(format_secret(part[0], new_secret))
+            secrets_count += 1
+    return secrets_count
+
+
+# vaults of a reencryption pool worker, created once per process
+worker_vaults = []
+
+def init_reencrypt_worker(password, new_password):
+    from ansible.parsing.vault import VaultLib, VaultSecret
+    from ansible import constants as C
+    worker_vaults[:] = [VaultLib([(C.DEFAULT_VAULT_IDENTITY, VaultSecret(password))]),
+                        VaultLib([(C.DEFAULT_VAULT_IDENTITY, VaultSecret(new_password))])]
+
+
+def reencrypt_secret_worker(secret):
+    # exceptions are returned rather than raised, so one bad secret doesn't fail the whole pool
+    try:
+        return reencrypt_secret(secret, *worker_vaults)
+    except Exception as e:
+        return Exception(str(e))
+
+
+def reencrypt_files(files, password, new_password, workers, memo=None):
+    # reencrypt {name: content} in a process pool, returns {name: (content, secrets_count)}.
+    # secrets of all files are queued as separate tasks, so both many small files and a single file with
+    # many secrets are spread over all workers, files without secrets never reach the pool.
+    # secrets found in memo are reused, so editing one secret of a file costs one secret worth of crypto
+    started = time.time()
+    parts = {name: list(iter_secrets(io.BytesIO(data))) for name, data in files.items()}
+    secrets = [part[1] for name in parts for part in parts[name] if not isinstance(part, bytes)]
+    memoized = memo.get(secrets) if memo else {}
+    todo = list(set(i for i in secrets if i not in memoized))
+    if not todo:
+        done = []
+    elif workers > 1 and len(todo) > 1:
+        with multiprocessing.Pool(min(workers, len(todo)), init_reencrypt_worker, (password, new_password)) as pool:
+            done = pool.map(reencrypt_secret_worker, todo, chunksize=max(1, len(todo) // (workers * 4)))
+    else:
+        init_reencrypt_worker(password, new_password)
+        done = [reencrypt_secret_worker(i) for i in todo]
+    if memo:
+        memo.put([(secret, new_secret) for secret, new_secret in zip(todo, done) if not isinstance(new_secret, Exception)])
+    memoized.update(zip(todo, done))
+    new_secrets = [memoized[i] for i in secrets]
+    result = {}
+    new_secrets = iter(new_secrets)
+    for name in parts:
+        out = io.BytesIO()
+        secrets_count = write_secrets(parts[name], new_secrets, out, name)
+        result[name] = (out.getvalue(), secrets_count)
+    duration = time.time() - started
+    if secrets:
+        reencrypted = sum(i[1] for i in result.values())
+        logging.info(f'Reencrypted {reencrypted} of {len(secrets)} secrets ({len(secrets) - len(todo)} reused from memo) in {len(files)} files '
+                     f'in {duration:.1f}s, {len(todo) / max(duration, 0.001):.1f} secrets/s with {workers} workers')
+    return result
+
+
+def reencrypt(src, dst, vault, new_vault):
+    # one streaming pass, output goes through a buffered writer and is kept only if there were secrets
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    secrets_count = 0
+    with open(src, 'rb') as file, open(f"{dst}.tmp", 'wb', buffering=1024 * 1024) as out:
+        for part in iter_secrets(file):
+            if isinstance(part, bytes):
+                out.write(part)
+                continue
+            try:
+                new_secret = reencrypt_secret(part[1], vault, new_vault)
+            except Exception as e:
+                new_secret = e
+            secrets_count += write_secrets([part], [new_secret], out, src)
     if secrets_count:
-        if not os.path.exists(os.path.dirname(dst)):
-            os.makedirs(os.path.dirname(dst))
-        with open(dst, 'wb') as file:
-            file.write(output)
+        os.rename(f"{dst}.tmp", dst)
+    else:
+        os.remove(f"{dst}.tmp")
     return secrets_count
 
 
-def add_parent_groups(groups, group_parents):
-    # recursively find all parent groups
-    for group in groups:
-        if group in group_parents:
-            groups = groups + add_parent_groups(group_parents[group], group_parents)
-    return groups
+class SecretMemo:
+    # reencrypted secrets by sha256 of original ciphertext, kept in reencrypt cache database next to whole files
+    def __init__(self, db, lock):
+        self.db     = db
+        self.lock   = lock
+
+    def get(self, secrets):
+        # {secret: reencrypted secret} for secrets found, refreshing their last access time
+        hashes = {hashlib.sha256(i).hexdigest(): i for i in secrets}
+        found = {}
+        now = round(time.time())
+        keys = list(hashes)
+        with self.lock, self.db:
+            # sqlite limits number of query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                marks = ','.join('?' * len(chunk))
+                for key, output in self.db.execute(f'SELECT key, output FROM secrets WHERE key IN ({marks})', chunk):
+                    found[hashes[key]] = output
+                self.db.execute(f'UPDATE secrets SET last_access = ? WHERE key IN ({marks})', [now] + chunk)
+        return found
+
+    def put(self, items):
+        now = round(time.time())
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO secrets VALUES (?, ?, ?)',
+                                [(hashlib.sha256(secret).hexdigest(), new_secret, now) for secret, new_secret in items])
+
+
+# bumped whenever stored output changes, so that old entries are not reused
+REENCRYPT_CACHE_VERSION = '2'
+
+def open_reencrypt_cache(path, *passwords):
+    # sqlite cache of reencrypted files, tied to vault passwords by a salted pbkdf2 fingerprint, so it is emptied
+    # when passwords change without keeping anything cheaper to brute force than vault itself.
+    # WAL journal keeps it consistent if server is killed in the middle of a write
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False)
+    os.chmod(path, 0o600)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS reencrypted (key TEXT PRIMARY KEY, secrets_count INTEGER, output BLOB, last_access INTEGER)')
+        db.execute('CREATE TABLE IF NOT EXISTS secrets (key TEXT PRIMARY KEY, output BLOB, last_access INTEGER)')
+        meta = dict(db.execute('SELECT name, value FROM meta'))
+        salt = meta.get('salt') or os.urandom(16).hex()
+        fingerprint = hashlib.pbkdf2_hmac('sha256', b'\0'.join(passwords), bytes.fromhex(salt), 100000).hex()
+        if meta.get('fingerprint') != fingerprint or meta.get('version') != REENCRYPT_CACHE_VERSION:
+            logging.info(f'Vault passwords or cache format changed or new reencrypt cache {path}, emptying it')
+            db.execute('DELETE FROM reencrypted')
+            db.execute('DELETE FROM secrets')
+            db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('salt', salt), ('fingerprint', fingerprint), ('version', REENCRYPT_CACHE_VERSION)])
+    return db
+
+
+def split_host_pattern(pattern):
+    # terms of a play hosts pattern - a list, or a string joined by ',' or ':' (not the one of a web[0:2] range)
+    if isinstance(pattern, list):
+        return [ii for i in pattern for ii in split_host_pattern(i)]
+    pattern = str(pattern)
+    terms = pattern.split(',') if ',' in pattern else re.split(r':(?![^\[]*\])', pattern)
+    return [i.strip() for i in terms if i.strip()]
+
+
+class InventoryIndex:
+    # built once per commit - transitive group closure of every host and hosts of every group, so that plays
+    # are selected by evaluating each hosts pattern once with set algebra instead of rescanning playbook per host
+
+    def __init__(self, host_groups, group_parents, group_members=None):
+        self.group_parents = group_parents
+        self.group_members = group_members
+        self.closures = {}
+        self.ordered = {}
+        # hosts mostly share same few combinations of groups, closure is computed once per combination
+        combinations = {}
+        combination_hosts = {}
+        self.host_groups = {}
+        for host, groups in host_groups.items():
+            key = tuple(groups)
+            if key not in combinations:
+                combinations[key] = sorted(set().union(*[self.closure(i) for i in groups]))
+                combination_hosts[key] = set()
+            self.host_groups[host] = combinations[key]
+            combination_hosts[key].add(host)
+        self.hosts = set(self.host_groups)
+        self.group_hosts = {'all': self.hosts, 'ungrouped': set()}
+        for group in set(group_parents).union(*group_parents.values()):
+            self.group_hosts.setdefault(group, set())
+        for key, groups in combinations.items():
+            for group in groups:
+                self.group_hosts.setdefault(group, set()).update(combination_hosts[key])
+        self.terms = {}
+
+    def closure(self, group):
+        # group with all its parents, memoized so shared ancestors of diamond shaped hierarchies are walked once
+        if group not in self.closures:
+            # placeholder stops cycles
+            self.closures[group] = {group}
+            groups = {group}
+            for parent in self.group_parents.get(group, []):
+                groups |= self.closure(parent)
+            self.closures[group] = groups
+        return self.closures[group]
+
+    def ordered_hosts(self, group):
+        # hosts of group in inventory order, the way ansible enumerates them before applying a subscript - own hosts,
+        # then hosts of children, level by level
+        if group not in self.ordered:
+            if group in ('all', '*'):
+                queue = [i for i in self.group_members if i not in self.group_parents]
+            else:
+                queue = [group]
+            hosts = []
+            seen = set(queue)
+            for name in queue:
+                own, children = self.group_members.get(name, ([], []))
+                hosts += own
+                queue += [i for i in children if i not in seen]
+                seen.update(children)
+            self.ordered[group] = list(dict.fromkeys(i for i in hosts if i in self.hosts))
+        return self.ordered[group]
+
+    def subscript(self, term, name, index, start, end):
+        # web[0], db[-1] and web[0:2] (end included) pick hosts by position. agents get a one host inventory, where
+        # every host would be web[0], so subscripts are resolved here, for groups only - order of hosts matched
+        # by wildcards isn't defined
+        if self.group_members is None or name not in self.group_hosts and name != '*':
+            logging.warning(f'Hosts pattern {term} is not a subscript of a group with known host order, it selects no hosts')
+            return set()
+        hosts = self.ordered_hosts(name)
+        if index is not None:
+            if not -len(hosts) <= int(index) < len(hosts):
+                logging.warning(f'Hosts pattern {term} is out of range of {len(hosts)} hosts, it selects no hosts')
+                return set()
+            return {hosts[int(index)]}
+        return set(hosts[int(start):int(end) + 1 if end else len(hosts)])
+
+    def match_term(self, term):
+        # hosts of one pattern term the way ansible enumerates them - matching groups first, hostnames only
+        # if no group matched or the term looks like a hostname, wildcard or ~regex
+        if term not in self.terms:
+            subscript = re.match(r'^([^~].*)\[(?:(-?[0-9]+)|([0-9]+)[:-]([0-9]*))\]$', term)
+            if subscript:
+                hosts = self.subscript(term, *subscript.groups())
+            elif term in ('all', '*'):
+                hosts = self.hosts
+            elif term.startswith('~') or any(i in term for i in '?*['):
+                regex = re.compile(term[1:] if term.startswith('~') else fnmatch.translate(term))
+                hosts = set().union(*[v for k, v in self.group_hosts.items() if regex.match(k)])
+                hosts |= set(i for i in self.hosts if regex.match(i))
+            else:
+                # plain name, dict lookups instead of scanning every group and host
+                hosts = self.group_hosts.get(term)
+                if hosts is None or '.' in term:
+                    hosts = (hosts or set()) | ({term} & self.hosts)
+            self.terms[term] = hosts
+        return self.terms[term]
+
+    def match(self, pattern):
+        # union terms first, then '&' intersections and '!' exclusions, same order ansible applies them in
+        terms = split_host_pattern(pattern)
+        hosts = set().union(*[self.match_term(i) for i in terms if i[0] not in '&!'] or [self.hosts])
+        for term in terms:
+            if term[0] == '&':
+                hosts &= self.match_term(term[1:])
+        for term in terms:
+            if term[0] == '!':
+                hosts -= self.match_term(term[1:])
+        return hosts
+
+    def plays(self, playbook, tag):
+        # plays with tag of every host, in playbook order
+        host_plays = {host: [] for host in self.host_groups}
+        for play in playbook:
+            tags = play.get('tags')
+            if type(tags) is list and tag in tags or type(tags) is str and tag == tags:
+                for host in self.match(play.get('hosts')):
+                    host_plays[host].append(play)
+        return host_plays
+
+
+def plan_build(host_groups, group_parents, playbook, tag='ansible-agent-run', group_members=None):
+    # build plan of a commit - groups, plays and inputs of every host and hosts of every role_hash, everything
+    # indexed by host or role_hash, so planning time stays linear in number of hosts (see BENCH/plan-bench.py)
+    inventory_index = InventoryIndex(host_groups, group_parents, group_members)
+    all_host_groups = inventory_index.host_groups
+    host_plays = inventory_index.plays(playbook, tag)
+
+    host_roles = {}
+    groups_roles = {}
+    role_hash_hosts = {}
+    for host in host_groups:
+        # plays every host of role_hash runs go to its shared site.yaml
+        role_hash = hash(' '.join(all_host_groups[host]))
+        if role_hash not in groups_roles:
+            groups_roles[role_hash] = host_plays[host]
+            role_hash_hosts[role_hash] = []
+        else:
+            plays = set(id(i) for i in host_plays[host])
+            groups_roles[role_hash] = [i for i in groups_roles[role_hash] if id(i) in plays]
+        role_hash_hosts[role_hash].append(host)
+        host_roles[host] = role_hash
+
+    host_deps = {}
+    for host in host_groups:
+        host_deps[host] = {
+            'groups':       all_host_groups[host],
+            'plays':        host_plays[host],
+            'shared_plays': groups_roles[host_roles[host]],
+            'inputs':       [f"group_vars/{i}" for i in ['all'] + all_host_groups[host]] + [f"host_vars/{host}"] +
+                            [f"roles/{ii['role']}" for i in host_plays[host] for ii in i['roles']],
+        }
+    return all_host_groups, host_plays, host_roles, groups_roles, role_hash_hosts, host_deps
+
+
+def changed_hosts(host_deps, previous, changed):
+    # hosts whose inputs differ from previous build or changed in git, all of them if changes are unknown
+    dirty = set()
+    for host, deps in host_deps.items():
+        prev = previous.get(host)
+        if (changed is None or prev is None or any(prev[k] != v for k, v in deps.items()) or
+            any(i in changed for i in deps['inputs'])):
+            dirty.add(host)
+    return dirty
 
 
 def parse_inventory(inventory):
@@ -75,6 +434,9 @@ def parse_inventory(inventory):
                     group_parents[child].append(groupname)
                 else:
                     group_parents[child] = [groupname]
+        # group variables are not hosts
+        elif re.match('.*:vars$', group):
+            continue
         # fill host groups dict
         else:
             for host in inventory[group]:
@@ -84,4 +446,385 @@ def parse_inventory(inventory):
                 else:
                     host_groups[hostname] = [group]
 
-    return host_groups, group_parents
\ No newline at end of file
+    return host_groups, group_parents
+
+
+def parse_group_members(inventory):
+    # {group: (hosts, child groups)} in the order inventory lists them, host order is what subscripts select from
+    group_members = {}
+    for section in inventory.sections():
+        if re.match('.*:vars$', section):
+            continue
+        hosts, children = group_members.setdefault(section.split(':')[0], ([], []))
+        if re.match('.*:children$', section):
+            children.extend(inventory[section])
+        else:
+            hosts.extend(i.split()[0] for i in inventory[section])
+    return group_members
+
+
+def system_lookup(host):
+    return sorted(set(i[4][0] for i in socket.getaddrinfo(host, None)))
+
+
+# getaddrinfo errors meaning the name doesn't exist, as opposed to resolver being unavailable
+NXDOMAIN_ERRORS = [i for i in (getattr(socket, 'EAI_NONAME', None), getattr(socket, 'EAI_NODATA', None)) if i is not None]
+
+
+class Resolver:
+    # host name -> IPs for nginx ACLs with a cache persisted between restarts. addresses are reused for ttl seconds,
+    # names that don't exist for negative_ttl seconds, and last known addresses are used while resolver fails or
+    # times out. after max_failures lookups in a row fail, the rest of the batch is served from cache without lookups,
+    # and besides `workers` lookups at most max_abandoned timed out ones are left running, so a hung resolver costs about one timeout per
+    # build. lookup is a function host -> [ips], system resolver by default, a fake one can be passed for testing
+    def __init__(self, cache_file, ttl=300, negative_ttl=60, timeout=5, workers=32, max_failures=32, max_abandoned=32,
+                 lookup=system_lookup):
+        self.cache_file     = cache_file
+        self.ttl            = ttl
+        self.negative_ttl   = negative_ttl
+        self.timeout        = timeout
+        self.workers        = workers
+        self.max_failures   = max_failures
+        self.max_abandoned  = max_abandoned
+        self.lookup         = lookup
+        self.cache          = {}
+        self.lock           = threading.Lock()
+        # lookups failed in a row in current batch, hosts served without lookup, lookup threads running
+        self.failures       = 0
+        self.skipped        = 0
+        self.running        = 0
+        try:
+            with open(cache_file) as file:
+                self.cache = json.load(file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f'Failed to load DNS cache {cache_file}, starting with empty one: {e}')
+
+    def lookup_with_timeout(self, host):
+        # getaddrinfo can't be interrupted, so it runs in a daemon thread which is abandoned after timeout
+        with self.lock:
+            if self.running >= self.workers + self.max_abandoned:
+                raise socket.timeout(f'{self.running} lookups still running')
+            self.running += 1
+        result = {}
+        def target():
+            try:
+                result['ips'] = self.lookup(host)
+            except Exception as e:
+                result['error'] = e
+            with self.lock:
+                self.running -= 1
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(self.timeout)
+        if thread.is_alive():
+            raise socket.timeout(f'timed out after {self.timeout}s')
+        if 'error' in result:
+            raise result['error']
+        return result['ips']
+
+    def resolve(self, host, refresh=False):
+        # returns list of IPs, empty if host can't be resolved and there are no known addresses
+        now = time.time()
+        entry = self.cache.get(host)
+        if not refresh and entry and now - entry['checked'] < (self.ttl if entry['ips'] else self.negative_ttl):
+            return entry['ips']
+        if self.failures >= self.max_failures:
+            # resolver is down, serve last known IPs or nothing instead of waiting a timeout per host
+            with self.lock:
+                self.skipped += 1
+            return entry['ips'] if entry else []
+        try:
+            ips = self.lookup_with_timeout(host)
+        except socket.gaierror as e:
+            if e.errno in NXDOMAIN_ERRORS:
+                self.failures = 0
+                self.cache[host] = {'ips': [], 'checked': now}
+                return []
+            error = e
+        except Exception as e:
+            error = e
+        else:
+            self.failures = 0
+            self.cache[host] = {'ips': ips, 'checked': now}
+            return ips
+        with self.lock:
+            self.failures += 1
+        if entry and entry['ips']:
+            # keep checked time as is, so the host is looked up again next time
+            logging.warning(f'Failed to resolve {host}: {error}, using last known IPs {entry["ips"]}')
+            return entry['ips']
+        logging.warning(f'Failed to resolve {host}: {error}')
+        return []
+
+    def resolve_all(self, hosts):
+        # resolve hosts concurrently with at most `workers` lookups in flight, persist cache of these hosts only,
+        # so hosts removed from inventory don't pile up
+        self.failures = 0
+        self.skipped = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            ips = dict(zip(hosts, pool.map(self.resolve, hosts)))
+        if self.skipped:
+            logging.warning(f'Resolver failed {self.max_failures} lookups in a row, {self.skipped} hosts served from cache without lookup')
+        self.cache = {k: v for k, v in self.cache.items() if k in ips}
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            write_json(self.cache_file, self.cache)
+        except Exception as e:
+            logging.warning(f'Failed to save DNS cache {self.cache_file}: {e}')
+        return ips
+
+
+def resolver_from_config(config):
+    return Resolver(config.get('dns', 'cache_file',         fallback='/opt/ansible-server/dns_cache.json'),
+                    ttl=int(config.get('dns', 'ttl_sec',           fallback=300)),
+                    negative_ttl=int(config.get('dns', 'negative_ttl_sec', fallback=60)),
+                    timeout=float(config.get('dns', 'timeout_sec',     fallback=5)),
+                    workers=int(config.get('dns', 'workers',           fallback=32)),
+                    max_failures=int(config.get('dns', 'max_failures',  fallback=32)),
+                    max_abandoned=int(config.get('dns', 'max_abandoned', fallback=32)))
+
+
+# {timestamp}_{commit sha} folders builds are published to
+COMMIT_FOLDER = re.compile('^[0-9]+_[0-9a-f]+$')
+
+class Collector:
+    # background garbage collector of published trees. document root is made of trees/{host}/{folder} - host
+    # folders, each built for one commit, generations/{commit}/{host} - links to folders agents may use and .latest,
+    # current - symlink to the generation nginx serves, ansiblectl/{host} - ansiblectl builds. builds report links of
+    # generations they publish, so references are counted in memory instead of listing every host folder. kept are
+    # folders linked by current generation and everything of commits being built. which commits next generation
+    # links is decided by retention policy in kept() - keep_commits newest, younger than keep_age_sec, only
+    # keep_commits while free space is below min_free_bytes - and commit of every host .latest. store objects are
+    # referenced by their hardlinks, link count 1 means only store refers to them. removals go in batches of
+    # batch_size followed by batch_pause_sec pause, so deletion I/O doesn't compete with builds
+    def __init__(self, path_prod, path_doc_root, path_store, keep_commits=3, keep_age_sec=7200, min_free_bytes=0,
+                 ansiblectl_age_sec=7500, batch_size=1000, batch_pause_sec=0.1, interval_sec=600, clock=time.time):
+        self.path_prod          = path_prod
+        self.path_doc_root      = path_doc_root
+        self.path_store         = path_store
+        self.keep_commits       = max(1, keep_commits)
+        self.keep_age_sec       = keep_age_sec
+        self.min_free_bytes     = min_free_bytes
+        self.ansiblectl_age_sec = ansiblectl_age_sec
+        self.batch_size         = batch_size
+        self.batch_pause_sec    = batch_pause_sec
+        self.interval_sec       = interval_sec
+        self.clock              = clock
+        self.lock               = threading.Lock()
+        self.wakeup             = threading.Event()
+        # set once trees published before start are known, builds wait for it to keep their links
+        self.scanned            = threading.Event()
+        # current generation and its {host: {commit: folder}} links
+        self.current            = None
+        self.links              = {}
+        # {host: (commit, folder)} agents are pointed to by .latest
+        self.latest             = {}
+        # what exists on disk - {host: set of folders}, commit folders in path_prod, generations
+        self.trees              = {}
+        self.prod               = set()
+        self.generations        = set()
+        self.legacy             = set()
+        self.pinned             = set()
+        self.inventory          = None
+        self.ansiblectl_swept   = 0
+        self.removed            = 0
+
+    def pin(self, commit):
+        # commit being built is never collected
+        with self.lock:
+            self.pinned.add(commit)
+            self.prod.add(commit)
+            self.generations.add(commit)
+
+    def kept(self):
+        # {host: {commit: folder}} new generation links besides the commit being built
+        self.scanned.wait()
+        now = self.clock()
+        with self.lock:
+            commits = sorted(set(ii for i in self.links.values() for ii in i), key=lambda i: int(i.split('_')[0]))
+            # commit being built is one of keep_commits
+            retained = set(commits[len(commits) - (self.keep_commits - 1):])
+            if self.min_free_bytes and shutil.disk_usage(self.path_prod).free < self.min_free_bytes:
+                logging.warning(f'GC: less than {self.min_free_bytes} bytes free in {self.path_prod}, keeping {self.keep_commits} newest commits only')
+            else:
+                retained.update(i for i in commits if int(i.split('_')[0]) >= now - self.keep_age_sec)
+            return {host: {k: v for k, v in links.items() if k in retained or (k, v) == self.latest.get(host)}
+                    for host, links in self.links.items()}
+
+    def publish(self, generation, links, built, inventory):
+        # links - {host: {commit: folder}} of generation, built - hosts .latest of which points to generation now,
+        # inventory - all hosts of generation
+        with self.lock:
+            self.current = generation
+            self.links = links
+            self.latest = {k: v for k, v in self.latest.items() if k in inventory}
+            self.latest.update((host, (generation, links[host][generation])) for host in built)
+            for host, folders in links.items():
+                self.trees.setdefault(host, set()).update(folders.values())
+            self.inventory = set(inventory)
+            self.pinned.discard(generation)
+        self.wakeup.set()
+
+    def scan(self):
+        # one full listing after start, to learn about trees published before it
+        trees = {}
+        links = {}
+        latest = {}
+        for host in os.listdir(f"{self.path_doc_root}/trees"):
+            trees[host] = set(i for i in os.listdir(f"{self.path_doc_root}/trees/{host}") if COMMIT_FOLDER.match(i))
+        current = None
+        if os.path.islink(f"{self.path_doc_root}/current"):
+            current = os.path.basename(os.readlink(f"{self.path_doc_root}/current"))
+            for host in os.listdir(f"{self.path_doc_root}/generations/{current}"):
+                path = f"{self.path_doc_root}/generations/{current}/{host}"
+                links[host] = {i: os.path.basename(os.readlink(f"{path}/{i}")) for i in os.listdir(path) if COMMIT_FOLDER.match(i)}
+                try:
+                    with open(f"{path}/.latest") as file:
+                        commit = json.load(file)['commit']
+                    latest[host] = (commit, links[host][commit])
+                except Exception:
+                    pass
+        prod = set(i for i in os.listdir(self.path_prod) if COMMIT_FOLDER.match(i))
+        generations = set(i for i in os.listdir(f"{self.path_doc_root}/generations") if COMMIT_FOLDER.match(i))
+        # host folders of layout without generations
+        legacy = set(os.listdir(self.path_doc_root)) - {'trees', 'generations', 'current', 'ansiblectl'}
+        with self.lock:
+            for host, folders in trees.items():
+                self.trees.setdefault(host, set()).update(folders)
+            self.prod.update(prod)
+            self.generations.update(generations)
+            self.legacy.update(i for i in legacy if not i.startswith('current'))
+            if self.current is None:
+                self.current = current
+                self.links = links
+                self.latest = latest
+        self.scanned.set()
+        logging.info(f'GC: found {len(generations)} generations, {len(prod)} commits of {len(trees)} hosts')
+
+    def tick(self):
+        self.removed += 1
+        if self.removed % self.batch_size == 0:
+            time.sleep(self.batch_pause_sec)
+
+    def remove(self, path):
+        # remove a folder, file or symlink without following symlinks, bottom up and throttled
+        try:
+            if os.path.islink(path) or not os.path.isdir(path):
+                os.remove(path)
+            else:
+                for root, dirs, files in os.walk(path, topdown=False):
+                    for name in files:
+                        os.remove(f"{root}/{name}")
+                        self.tick()
+                    for name in dirs:
+                        if os.path.islink(f"{root}/{name}"):
+                            os.remove(f"{root}/{name}")
+                        else:
+                            os.rmdir(f"{root}/{name}")
+                        self.tick()
+                os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        self.tick()
+
+    def plan(self):
+        # what to remove, decided under lock from the reference index only, so it takes no I/O
+        live = set((host, folder) for host, links in self.links.items() for folder in links.values())
+        live_folders = set(i[1] for i in live)
+        folders = [(host, folder) for host, folders in self.trees.items() for folder in folders
+                   if (host, folder) not in live and folder not in self.pinned]
+        commits = [i for i in self.prod if i not in live_folders and i not in self.pinned]
+        generations = [i for i in self.generations if i != self.current and i not in self.pinned]
+        hosts = []
+        legacy = []
+        if self.inventory is not None:
+            left = set(i[0] for i in live)
+            hosts = [i for i in self.trees if i not in self.inventory and i not in left]
+            legacy = list(self.legacy)
+        return folders, commits, generations, hosts, legacy
+
+    def collect(self):
+        started = time.time()
+        self.removed = 0
+        with self.lock:
+            folders, commits, generations, hosts, legacy = self.plan()
+        # generations first, they are what links to everything else
+        for generation in generations:
+            self.remove(f"{self.path_doc_root}/generations/{generation}")
+        for host, folder in folders:
+            self.remove(f"{self.path_doc_root}/trees/{host}/{folder}")
+        for host in hosts:
+            logging.info(f"GC: removing folders of host not in inventory {host}")
+            self.remove(f"{self.path_doc_root}/trees/{host}")
+            self.remove(f"{self.path_doc_root}/ansiblectl/{host}")
+        for name in legacy:
+            logging.info(f"GC: removing {self.path_doc_root}/{name} of layout without generations")
+            self.remove(f"{self.path_doc_root}/{name}")
+        for commit in commits:
+            logging.info(f"GC: removing {self.path_prod}/{commit}")
+            self.remove(f"{self.path_prod}/{commit}")
+        with self.lock:
+            self.generations.difference_update(generations)
+            for host, folder in folders:
+                self.trees[host].discard(folder)
+            for host in hosts:
+                self.trees.pop(host, None)
+            self.legacy.difference_update(legacy)
+            self.prod.difference_update(commits)
+
+        # stored files no tree links to anymore, builds run meanwhile - files being stored are skipped, and builds
+        # store again objects removed between their check and link
+        stored = 0
+        if folders or commits or hosts or legacy:
+            for root, dirs, files in os.walk(self.path_store):
+                for name in files:
+                    if not name.endswith('.tmp') and os.lstat(f"{root}/{name}").st_nlink == 1:
+                        os.remove(f"{root}/{name}")
+                        stored += 1
+                        self.tick()
+
+        # ansiblectl folders are written by ansiblectl-server, so they are found by listing, once per interval
+        ansiblectl = 0
+        if self.clock() - self.ansiblectl_swept >= self.interval_sec:
+            self.ansiblectl_swept = self.clock()
+            for host in os.listdir(f"{self.path_doc_root}/ansiblectl"):
+                for folder in os.listdir(f"{self.path_doc_root}/ansiblectl/{host}"):
+                    if COMMIT_FOLDER.match(folder) and int(folder.split('_')[0]) < self.clock() - self.ansiblectl_age_sec:
+                        self.remove(f"{self.path_doc_root}/ansiblectl/{host}/{folder}")
+                        ansiblectl += 1
+
+        if folders or commits or generations or hosts or legacy or stored or ansiblectl:
+            logging.info(f'GC: removed {len(generations)} generations, {len(folders)} host folders, {len(commits)} commits, {len(hosts)} hosts, '
+                         f'{stored} stored files, {ansiblectl} ansiblectl folders, {self.removed} paths in {time.time() - started:.1f}s')
+
+    def run(self):
+        try:
+            self.scan()
+        except Exception as e:
+            logging.error(f'GC: failed to scan published trees: {e}')
+            self.scanned.set()
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                logging.error(f'GC: failed: {e}')
+            self.wakeup.wait(self.interval_sec)
+            self.wakeup.clear()
+
+    def start(self):
+        threading.Thread(target=self.run, name='gc', daemon=True).start()
+
+
+def collector_from_config(config):
+    return Collector(config.get('ansible-server', 'path_prod'),
+                     config.get('ansible-server', 'path_doc_root'),
+                     config.get('ansible-server', 'path_store',           fallback=f"{config.get('ansible-server', 'path_prod')}/.store"),
+                     keep_commits=int(config.get('gc', 'keep_commits',              fallback=3)),
+                     keep_age_sec=int(config.get('gc', 'keep_age_sec',              fallback=7200)),
+                     min_free_bytes=int(config.get('gc', 'min_free_mb',             fallback=0)) * 2**20,
+                     ansiblectl_age_sec=int(config.get('gc', 'ansiblectl_age_sec',  fallback=7500)),
+                     batch_size=int(config.get('gc', 'batch_size',                  fallback=1000)),
+                     batch_pause_sec=float(config.get('gc', 'batch_pause_sec',      fallback=0.1)),
+                     interval_sec=int(config.get('gc', 'interval_sec',              fallback=600)))
@@ -32,8 +32,15 @@ try:
         branch = post_params['branch']
         remote_addr = os.environ.get('REMOTE_ADDR')
         
-        # check host ip addr
-        ips = sorted(set(i[4][0] for i in socket.getaddrinfo(host, None)))
+        # check host ip addr, against addresses cached by ansible-server first, looking host up only if they don't match
+        from configparser import ConfigParser
+        from ansible_server_functions import resolver_from_config
+        config = ConfigParser()
+        config.read('/etc/ansible-server/ansible-server.conf')
+        resolver = resolver_from_config(config)
+        ips = resolver.resolve(host)
+        if remote_addr not in ips:
+            ips = resolver.resolve(host, refresh=True)
         if remote_addr not in ips:
             raise Exception(f"IP {remote_addr} doesn't belong to host {host}")
         
@@ -142,8 +149,9 @@ try:
 
 
     # check if prepared folder exists
-    if os.path.exists(f"{path_doc_root}/{host}/ansiblectl"):
-        for folder in sorted(os.listdir(f"{path_doc_root}/{host}/ansiblectl")):
+    # ansiblectl builds live outside of generations, every generation links host ansiblectl folder to them
+    if os.path.exists(f"{path_doc_root}/ansiblectl/{host}"):
+        for folder in sorted(os.listdir(f"{path_doc_root}/ansiblectl/{host}")):
             folder_parts = folder.split('_')
             folder_ts = folder_parts[0]
             folder_commit = folder_parts[1]
@@ -175,21 +183,15 @@ try:
 
 
     host_groups, group_parents = parse_inventory(inventory)
-    all_host_groups = {}
-    all_host_groups[host] = sorted(set(add_parent_groups(host_groups[host], group_parents)))
+    inventory_index = InventoryIndex(host_groups, group_parents, parse_group_members(inventory))
+    all_host_groups = inventory_index.host_groups
     
     path_host = f"{path_tmp}/{host}/ansiblectl/{timestamp}_{commit_sha}"
     logging.debug (f"create {path_host}")
     os.makedirs(f"{path_host}")
     
     
-    all_host_roles  = []
-    for play in playbook:
-        if (type(play['tags']) is list and 'ansible-agent-run' in play['tags'] or
-            type(play['tags']) is str  and 'ansible-agent-run' == play['tags']):
-            if (type(play['hosts']) is list and set(play['hosts']) & set([host, 'all'] + all_host_groups[host]) or
-                type(play['hosts']) is str  and play['hosts'] in [host, 'all'] + all_host_groups[host]):
-                    all_host_roles.append(play)
+    all_host_roles  = inventory_index.plays(playbook, 'ansible-agent-run')[host]
     logging.debug(pprint.pformat({'host': host, 'roles': all_host_roles}))    
 
     # write inventory for host
@@ -235,9 +237,14 @@ try:
                 copy_with_reencrypt(GIT_LOCAL_PATH, f"roles/{role}/defaults/{vars}", f"{path_host}/roles/{role}/defaults/{vars}")
 
 
+    # single archive with the whole project for this host, so ansiblectl can fetch it in one request
+    logging.debug (f"create {path_host}/.bundle.tar.gz")
+    make_bundle(f"{path_host}/.bundle.tar.gz", [(f"{path_host}/{i}", i) for i in sorted(os.listdir(path_host))])
+
     # move prepared folder structure to document root
-    logging.debug (f"mv  {path_host}   {path_doc_root}/{host}/ansiblectl/{timestamp}_{commit_sha}")
-    shutil.move(f"{path_host}", f"{path_doc_root}/{host}/ansiblectl/{timestamp}_{commit_sha}")
+    logging.debug (f"mv  {path_host}   {path_doc_root}/ansiblectl/{host}/{timestamp}_{commit_sha}")
+    os.makedirs(f"{path_doc_root}/ansiblectl/{host}", exist_ok=True)
+    shutil.move(f"{path_host}", f"{path_doc_root}/ansiblectl/{host}/{timestamp}_{commit_sha}")
 
     
     # cleanup